@@ -5,10 +5,11 @@ import logging
 import os
 import sys
 from functools import wraps
+from pathlib import Path
 from subprocess import CalledProcessError
 
 import a2km
-from a2km import operations
+from a2km import _completion, operations
 
 
 def _quieter_errors(f):
@@ -39,10 +40,97 @@ def _kernelspec_arg(
     parser.add_argument("kernelspec", type=str, help=help)
 
 
-@_quieter_errors
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv[1:]
+def _selection_args(parser: argparse.ArgumentParser) -> None:
+    """Arguments for commands that can apply to many kernelspecs"""
+    _kernelspec_arg(
+        parser,
+        help="A kernelspec name or path, or a glob pattern matching kernelspec names (e.g. 'conda-*')",
+    )
+    parser.add_argument(
+        "--where",
+        action="append",
+        default=[],
+        metavar="KEY=PATTERN",
+        help="Only apply to kernelspecs matching a selector: argv0=PATTERN, env=KEY, or a field such as language=python. May be given more than once.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of kernelspecs to process in parallel when more than one is selected",
+    )
+    _admin_args(parser)
+
+
+def _admin_args(parser: argparse.ArgumentParser) -> None:
+    """Arguments for applying to other users' kernelspecs"""
+    parser.add_argument(
+        "--users-root",
+        default=None,
+        help="Apply to the kernelspecs of every user with a home directory here (e.g. /home), instead of the kernelspecs on the search path.",
+    )
+    parser.add_argument(
+        "--data-dir",
+        action="append",
+        default=[],
+        help="Apply to the kernelspecs in this Jupyter data directory, instead of the kernelspecs on the search path. May be given more than once.",
+    )
+
+
+def _admin_kernels_dirs(options: argparse.Namespace) -> dict[Path, str]:
+    """Kernels directories from --users-root and --data-dir
+
+    Returns a dict of kernels directories to labels for reporting.
+    """
+    kernels_dirs: dict[Path, str] = {}
+    if options.users_root:
+        for user, kernels_dir in operations.user_kernels_dirs(
+            options.users_root
+        ).items():
+            kernels_dirs[kernels_dir.absolute()] = user
+    for data_dir in options.data_dir:
+        kernels_dirs[(Path(data_dir) / "kernels").absolute()] = data_dir
+    return kernels_dirs
+
+
+def _is_pattern(kernelspec: str) -> bool:
+    return any(c in kernelspec for c in "*?[")
+
+
+def _apply_to_selection(
+    op, kernelspecs, *args, max_workers=None, labels: dict[Path, str] | None = None
+) -> None:
+    """Apply an operation to many kernelspecs and report the results
+
+    If labels are given, results are also summarized
+    for each label of the kernelspecs' kernels directories (e.g. users).
+    """
+    results = operations.map_kernelspecs(
+        op, kernelspecs, *args, max_workers=max_workers
+    )
+    failed = 0
+    # label: [ok, failed]
+    summary: dict[str, list[int]] = {}
+    for kernelspec, error in results.items():
+        if error is None:
+            print(f"{kernelspec}: ok")
+        else:
+            failed += 1
+            print(f"{kernelspec}: failed: {error}")
+        if labels:
+            counts = summary.setdefault(labels[kernelspec.parent], [0, 0])
+            counts[error is not None] += 1
+    if summary:
+        print("\nSummary:")
+        for label, (ok_count, failed_count) in sorted(summary.items()):
+            print(f"  {label}: {ok_count} ok, {failed_count} failed")
+    if failed:
+        sys.exit(f"{failed} of {len(results)} kernelspecs failed")
+
+
+def _build_parser() -> tuple[argparse.ArgumentParser, argparse._SubParsersAction]:
+    """Build the argument parser and its subcommands"""
     parser = argparse.ArgumentParser("a2km")
     parser.add_argument("--version", action="version", version=a2km.__version__)
     parser.add_argument("--debug", action="store_true")
@@ -66,12 +154,12 @@ def main(argv=None):
     clone.add_argument("to", help="The name (or full path) to clone KERNELSPEC to")
 
     set_cmd = _subcommand(subparsers, "set")
-    _kernelspec_arg(set_cmd)
+    _selection_args(set_cmd)
     set_cmd.add_argument("key", type=str, help="field to set (e.g. 'display_name')")
     set_cmd.add_argument("value", type=str, help="value to set (e.g. 'My Kernel')")
 
     add_env = _subcommand(subparsers, "add-env")
-    _kernelspec_arg(add_env)
+    _selection_args(add_env)
     add_env.add_argument(
         "env",
         nargs="+",
@@ -79,7 +167,7 @@ def main(argv=None):
     )
 
     rm_env = _subcommand(subparsers, "rm-env", "remove_env")
-    _kernelspec_arg(rm_env)
+    _selection_args(rm_env)
     rm_env.add_argument(
         "env",
         nargs="+",
@@ -87,21 +175,64 @@ def main(argv=None):
     )
 
     add_argv = _subcommand(subparsers, "add-argv")
-    _kernelspec_arg(add_argv)
+    _selection_args(add_argv)
     add_argv.add_argument(
         "args",
         nargs="+",
         help="cli args to add.",
     )
 
+    add_argv.add_argument(
+        "--prepend",
+        action="store_true",
+        help="Add the args at the beginning of argv, e.g. a wrapper command",
+    )
+
     rm_argv = _subcommand(subparsers, "rm-argv", "remove_argv")
-    _kernelspec_arg(rm_argv)
+    _selection_args(rm_argv)
     rm_argv.add_argument(
         "args",
         nargs="+",
         help="cli args to remove.",
     )
 
+    prewarm = _subcommand(subparsers, "prewarm")
+    _kernelspec_arg(prewarm)
+    prewarm.add_argument(
+        "preload",
+        nargs="*",
+        help="Modules to preload in the forkserver, in addition to ipykernel (e.g. numpy pandas).",
+    )
+    prewarm.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600,
+        help="Seconds without any running kernels before the forkserver exits.",
+    )
+    prewarm.add_argument(
+        "--disable",
+        action="store_true",
+        help="Stop using the forkserver, and launch the kernel directly.",
+    )
+
+    profile = _subcommand(subparsers, "profile")
+    _kernelspec_arg(profile)
+    profile.add_argument("-o", "--output", help="Save the profile as JSON to this file")
+    profile.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for the kernel to be ready",
+    )
+    profile.add_argument(
+        "--top", type=int, default=20, help="Number of entries to show in rankings"
+    )
+    profile.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Track memory allocations with tracemalloc. Makes imports slower.",
+    )
+
     env_kernel = _subcommand(subparsers, "env-kernel")
     env_kernel.add_argument("env", help="Path or name of an environment")
     env_kernel.add_argument(
@@ -116,13 +247,154 @@ def main(argv=None):
         default="sys-prefix",
         help="The install prefix. Can be 'user' for a per-user install 'sys-prefix' for the same installation prefix as the a2km tool (default), or a path to an installation prefix.",
     )
+    env_kernel.add_argument(
+        "--precompile",
+        action="store_true",
+        help="Precompile the env's bytecode. If the env isn't writable, bytecode is stored in the kernelspec directory.",
+    )
+    env_kernel.add_argument(
+        "--freeze",
+        action="store_true",
+        help="Make the kernelspec directory reproducible (see `a2km freeze`).",
+    )
+
+    precompile = _subcommand(subparsers, "precompile")
+    precompile.add_argument("env", help="Path or name of an environment")
+    precompile.add_argument(
+        "--kind",
+        choices={"conda", "venv"},
+        default="conda",
+        help="The kind of environment",
+    )
+    precompile.add_argument(
+        "--pycache-prefix",
+        default=None,
+        help="Where to store bytecode if the env isn't writable (default: in ~/.cache/a2km). Set PYTHONPYCACHEPREFIX to this directory to use it.",
+    )
+    precompile.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="Number of parallel jobs (default: number of CPUs)",
+    )
+
+    freeze = _subcommand(subparsers, "freeze")
+    _kernelspec_arg(freeze)
+    freeze.add_argument(
+        "--mtime",
+        type=int,
+        default=None,
+        help="The mtime (seconds since epoch) to set on all files (default: $SOURCE_DATE_EPOCH, or 0)",
+    )
+
+    build_catalog = _subcommand(subparsers, "build-catalog")
+    build_catalog.add_argument(
+        "kernels_dir",
+        help="The kernels directory to catalog (e.g. $prefix/share/jupyter/kernels)",
+    )
 
     rm = _subcommand(subparsers, "rm", "remove")
-    _kernelspec_arg(rm)
+    _selection_args(rm)
     rm.add_argument(
         "--force", action="store_true", help="Skip confirmation before removal."
     )
+    rm.add_argument(
+        "--no-purge",
+        dest="purge",
+        action="store_false",
+        help="Leave removed kernelspecs in the trash for `a2km purge`, instead of deleting them in the background.",
+    )
+
+    purge = _subcommand(subparsers, "purge")
+    purge.add_argument(
+        "kernels_dirs",
+        nargs="*",
+        help="Kernels directories to purge (default: all on the search path)",
+    )
+    purge.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of kernelspecs to delete in parallel",
+    )
+    _admin_args(purge)
+
+    dedupe = _subcommand(subparsers, "dedupe")
+    dedupe.add_argument(
+        "kernels_dirs",
+        nargs="*",
+        help="Kernels directories to deduplicate (default: all on the search path)",
+    )
+    dedupe.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report what would be reclaimed, without linking anything",
+    )
+    dedupe.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of files to hash in parallel",
+    )
+
+    resources = _subcommand(subparsers, "resources")
+    _selection_args(resources)
+    resources.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of threads for OpenMP, MKL and OpenBLAS (default: the number of --cpus)",
+    )
+    resources.add_argument(
+        "--cpus",
+        default=None,
+        help="CPUs to run the kernel on, with taskset (e.g. '0-3,8')",
+    )
+    resources.add_argument(
+        "--memory",
+        default=None,
+        help="Limit the kernel's memory (address space) with prlimit (e.g. '8G')",
+    )
+    resources.add_argument(
+        "--clear",
+        action="store_true",
+        help="Remove the resource settings a2km added to the kernelspec",
+    )
 
+    exec_cmd = _subcommand(subparsers, "exec", "exec_command")
+    _kernelspec_arg(exec_cmd)
+    exec_cmd.add_argument(
+        "cmd",
+        nargs="*",
+        help="The command to run, after `--` (default: $SHELL)",
+    )
+
+    completion = subparsers.add_parser(
+        "completion", help="Print a shell completion script"
+    )
+    completion.set_defaults(operation=_completion.script)
+    completion.add_argument(
+        "shell",
+        nargs="?",
+        choices=_completion.SHELLS,
+        help='The shell to complete, e.g. `eval "$(a2km completion bash)"`',
+    )
+    completion.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Refresh the cache of kernelspec names for completion, instead of printing a script",
+    )
+    return parser, subparsers
+
+
+@_quieter_errors
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser, subparsers = _build_parser()
     options = parser.parse_args(argv)
     if options.debug:
         level = logging.DEBUG
@@ -138,8 +410,99 @@ def main(argv=None):
         operations.show(options.kernelspec, options.json)
     elif op is operations.clone:
         operations.clone(options.kernelspec, options.to)
-    elif op is operations.set:
-        operations.set(options.kernelspec, {options.key: options.value})
+    elif op in {
+        operations.set,
+        operations.add_env,
+        operations.remove_env,
+        operations.add_argv,
+        operations.remove_argv,
+        operations.remove,
+        operations.resources,
+    }:
+        _selectable_operation(options)
+    elif op is operations.prewarm:
+        operations.prewarm(
+            options.kernelspec,
+            options.preload,
+            idle_timeout=options.idle_timeout,
+            disable=options.disable,
+        )
+    elif op is operations.profile:
+        operations.profile(
+            options.kernelspec,
+            timeout=options.timeout,
+            output=options.output,
+            top=options.top,
+            tracemalloc=options.tracemalloc,
+        )
+    elif op is operations.env_kernel:
+        operations.env_kernel(
+            options.env,
+            kind=options.kind,
+            kernel_name=options.name,
+            install_prefix=options.prefix,
+            compile_bytecode=options.precompile,
+            freeze_output=options.freeze,
+        )
+    elif op is operations.freeze:
+        operations.freeze(options.kernelspec, mtime=options.mtime)
+    elif op is operations.precompile:
+        pycache_prefix = operations.precompile(
+            options.env,
+            kind=options.kind,
+            pycache_prefix=options.pycache_prefix,
+            jobs=options.jobs,
+        )
+        if pycache_prefix:
+            print(f"PYTHONPYCACHEPREFIX={pycache_prefix}")
+    elif op is operations.purge:
+        kernels_dirs = options.kernels_dirs + list(_admin_kernels_dirs(options))
+        if (options.users_root or options.data_dir) and not kernels_dirs:
+            sys.exit("No kernels directories found")
+        results = operations.purge(kernels_dirs, max_workers=options.jobs)
+        failed = sum(error is not None for error in results.values())
+        print(f"Purged {len(results) - failed} removed kernelspecs")
+        if failed:
+            sys.exit(f"Failed to delete {failed} removed kernelspecs")
+    elif op is operations.dedupe:
+        reclaimed_bytes, reclaimed_inodes, skipped = operations.dedupe(
+            options.kernels_dirs, dry_run=options.dry_run, max_workers=options.jobs
+        )
+        would = "Would reclaim" if options.dry_run else "Reclaimed"
+        print(
+            f"{would} {operations._format_bytes(reclaimed_bytes)} in {reclaimed_inodes} files"
+        )
+        if skipped:
+            print(f"Skipped {skipped} files that could not be linked")
+    elif op is operations.build_catalog:
+        print(operations.build_catalog(options.kernels_dir))
+    elif op is operations.exec_command:
+        operations.exec_command(options.kernelspec, options.cmd)
+    elif op is _completion.script:
+        if options.refresh:
+            _completion.refresh_cache()
+        elif options.shell:
+            print(_completion.script(options.shell, parser), end="")
+        else:
+            sys.exit(f"Specify a shell, one of: {', '.join(_completion.SHELLS)}")
+    else:
+        sys.exit(f"Specify an operation, one of: {', '.join(subparsers.choices)}")
+
+    if op in {
+        operations.clone,
+        operations.remove,
+        operations.env_kernel,
+        operations.purge,
+    }:
+        # kernelspecs were added or removed
+        _completion.refresh_cache(only_if_exists=True)
+
+
+def _selectable_operation(options: argparse.Namespace) -> None:
+    """Run an operation that can apply to many kernelspecs"""
+    op = options.operation
+    if op is operations.set:
+        args: tuple = ({options.key: options.value},)
     elif op is operations.add_env:
         new_env = {}
         for assignment in options.env:
@@ -150,24 +513,61 @@ def main(argv=None):
                 except KeyError:
                     sys.exit(f"No such env set: {key}")
             new_env[key] = value
-        operations.add_env(options.kernelspec, new_env)
+        args = (new_env,)
     elif op is operations.remove_env:
-        operations.remove_env(options.kernelspec, options.env)
+        args = (options.env,)
     elif op is operations.add_argv:
-        operations.add_argv(options.kernelspec, options.args)
+        args = (options.args, options.prepend)
     elif op is operations.remove_argv:
-        operations.remove_argv(options.kernelspec, options.args)
-    elif op is operations.env_kernel:
-        operations.env_kernel(
-            options.env,
-            kind=options.kind,
-            kernel_name=options.name,
-            install_prefix=options.prefix,
-        )
+        args = (options.args,)
+    elif op is operations.resources:
+        args = (options.threads, options.cpus, options.memory, options.clear)
+        if not options.clear and args[:3] == (None, None, None):
+            sys.exit("Specify --threads, --cpus, --memory, or --clear")
     elif op is operations.remove:
-        operations.remove(options.kernelspec, options.force)
-    else:
-        sys.exit(f"Specify an operation, one of: {', '.join(subparsers.choices)}")
+        args = (options.force, options.purge)
+
+    labels = _admin_kernels_dirs(options)
+    if options.users_root or options.data_dir:
+        if not labels:
+            sys.exit("No kernels directories found")
+    elif not options.where and not _is_pattern(options.kernelspec):
+        op(options.kernelspec, *args)
+        return
+
+    try:
+        kernelspecs = operations.find_kernelspecs(
+            options.kernelspec,
+            options.where,
+            kernels_dirs=list(labels) if labels else None,
+            # every user's kernelspecs, not just the first with each name
+            unique=not labels,
+            # don't let users point root at other files
+            follow_symlinks=not labels,
+        )
+    except ValueError as e:
+        sys.exit(str(e))
+    if not kernelspecs:
+        sys.exit(f"No kernelspecs match {options.kernelspec}")
+    if op is operations.remove:
+        if not options.force:
+            # confirm once, instead of for each kernelspec
+            for kernelspec in kernelspecs:
+                print(kernelspec)
+            ans = input(f"Remove {len(kernelspecs)} kernelspecs [y/N]? ")
+            if not ans.lower().startswith("y"):
+                print("Operation cancelled", file=sys.stderr)
+                return
+        # purge once per kernels directory, after removing all of them
+        args = (True, False)
+    try:
+        _apply_to_selection(
+            op, kernelspecs, *args, max_workers=options.jobs, labels=labels
+        )
+    finally:
+        if op is operations.remove and options.purge:
+            for kernels_dir in {kernelspec.parent for kernelspec in kernelspecs}:
+                operations._purge_in_background(kernels_dir)
 
 
 if __name__ == "__main__":
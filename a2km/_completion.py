@@ -0,0 +1,237 @@
+"""Shell completion scripts for a2km
+
+Completion must be fast, so the generated scripts never run Python.
+Kernelspec names are read from a cache file,
+which a2km refreshes when it adds or removes kernelspecs.
+Each completion also starts a background check (in sh)
+for kernels directories modified since the cache was written,
+which refreshes the cache for the next completion,
+so a slow filesystem never blocks the shell.
+"""
+
+from __future__ import annotations
+
+import argparse
+import shlex
+import sys
+from pathlib import Path
+
+from a2km import operations
+
+SHELLS = ("bash", "zsh", "fish")
+
+_GLOBAL_OPTIONS = ["-h", "--help", "--version", "--debug"]
+
+
+def cache_path() -> Path:
+    """The file listing kernelspec names, one per line"""
+    return operations._cache_dir() / "completion" / "kernelspecs"
+
+
+def _kernels_dirs_path() -> Path:
+    """The file listing the kernels directories the names were read from"""
+    return cache_path().with_name("kernels-dirs")
+
+
+def refresh_cache(only_if_exists: bool = False) -> Path:
+    """Write the kernelspec names on the search path to the completion cache
+
+    With only_if_exists, only refresh a cache that's already there,
+    so a2km doesn't write caches for users who don't use completion.
+    """
+    path = cache_path()
+    if only_if_exists and not path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    kernels_dirs = operations._kernels_dirs()
+    names: set[str] = set()
+    for kernels_dir in kernels_dirs:
+        names.update(operations._list_kernelspecs(kernels_dir))
+    # written last, because its mtime is compared to the kernels directories
+    with operations._atomic_write(_kernels_dirs_path()) as f:
+        f.writelines(f"{kernels_dir}\n" for kernels_dir in kernels_dirs)
+    with operations._atomic_write(path) as f:
+        f.writelines(f"{name}\n" for name in sorted(names))
+    return path
+
+
+def _refresh_snippet() -> str:
+    """sh code to refresh the cache in the background, if it's stale"""
+    refresh = shlex.join([sys.executable, "-m", "a2km", "completion", "--refresh"])
+    return f"""(
+cache={shlex.quote(str(cache_path()))}
+dirs={shlex.quote(str(_kernels_dirs_path()))}
+stale=
+if [ ! -f "$cache" ] || [ ! -f "$dirs" ]; then
+    stale=1
+else
+    while IFS= read -r dir; do
+        if [ -n "$(find "$dir" -prune -newer "$cache" 2>/dev/null)" ]; then
+            stale=1
+            break
+        fi
+    done < "$dirs"
+fi
+if [ -n "$stale" ]; then
+    exec {refresh}
+fi
+) </dev/null >/dev/null 2>&1 &"""
+
+
+def _commands(parser: argparse.ArgumentParser) -> dict[str, tuple[list[str], bool]]:
+    """Subcommands with their options and whether they take a kernelspec"""
+    commands = {}
+    for action in parser._actions:
+        if not isinstance(action, argparse._SubParsersAction):
+            continue
+        for name, subparser in action.choices.items():
+            options = [
+                option
+                for sub_action in subparser._actions
+                for option in sub_action.option_strings
+            ]
+            takes_kernelspec = any(
+                sub_action.dest == "kernelspec" for sub_action in subparser._actions
+            )
+            commands[name] = (options, takes_kernelspec)
+    return commands
+
+
+def _bash(parser: argparse.ArgumentParser) -> str:
+    commands = _commands(parser)
+    cases = []
+    for name, (options, takes_kernelspec) in commands.items():
+        words = "_a2km_kernelspecs" if takes_kernelspec else ":"
+        cases.append(f'        {name}) opts="{" ".join(options)}"; {words} ;;')
+    cases_str = "\n".join(cases)
+    cache = shlex.quote(str(cache_path()))
+    return f"""# bash completion for a2km, generated by `a2km completion bash`
+
+_a2km_kernelspecs() {{
+    sh -c {shlex.quote(_refresh_snippet())}
+    if [[ -r {cache} ]]; then
+        words=$(< {cache})
+    fi
+}}
+
+_a2km() {{
+    local cur=${{COMP_WORDS[COMP_CWORD]}}
+    local cmd="" opts="" words="" i
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        if [[ ${{COMP_WORDS[i]}} != -* ]]; then
+            cmd=${{COMP_WORDS[i]}}
+            break
+        fi
+    done
+    case $cmd in
+        "") opts="{" ".join(_GLOBAL_OPTIONS)}"; words="{" ".join(commands)}" ;;
+{cases_str}
+    esac
+    if [[ $cur == -* ]]; then
+        COMPREPLY=($(compgen -W "$opts" -- "$cur"))
+    else
+        COMPREPLY=($(compgen -W "$words" -- "$cur"))
+    fi
+}}
+
+complete -o default -F _a2km a2km
+"""
+
+
+def _zsh(parser: argparse.ArgumentParser) -> str:
+    commands = _commands(parser)
+    cases = []
+    for name, (options, takes_kernelspec) in commands.items():
+        cases.append(
+            f"        {name}) opts=({' '.join(options)}); kernelspecs={int(takes_kernelspec)} ;;"
+        )
+    cases_str = "\n".join(cases)
+    cache = shlex.quote(str(cache_path()))
+    return f"""# zsh completion for a2km, generated by `a2km completion zsh`
+
+_a2km() {{
+    local cmd="" word
+    local -a opts
+    local kernelspecs=0
+    for word in ${{words[2,CURRENT-1]}}; do
+        if [[ $word != -* ]]; then
+            cmd=$word
+            break
+        fi
+    done
+    case $cmd in
+        "")
+            if [[ $PREFIX == -* ]]; then
+                compadd -- {" ".join(_GLOBAL_OPTIONS)}
+            else
+                compadd -- {" ".join(commands)}
+            fi
+            return
+            ;;
+{cases_str}
+    esac
+    if [[ $PREFIX == -* ]]; then
+        compadd -- $opts
+    elif (( kernelspecs )); then
+        sh -c {shlex.quote(_refresh_snippet())}
+        if [[ -r {cache} ]]; then
+            compadd -- ${{(f)"$(< {cache})"}}
+        fi
+        _files
+    else
+        _files
+    fi
+}}
+
+compdef _a2km a2km
+"""
+
+
+def _fish(parser: argparse.ArgumentParser) -> str:
+    commands = _commands(parser)
+    subcommand_help = {}
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            for choice_action in action._choices_actions:
+                subcommand_help[choice_action.dest] = (choice_action.help or "").split(
+                    "\n"
+                )[0]
+    cache = shlex.quote(str(cache_path()))
+    lines = [
+        "# fish completion for a2km, generated by `a2km completion fish`",
+        "",
+        "function __a2km_kernelspecs",
+        f"    sh -c {shlex.quote(_refresh_snippet())}",
+        f"    test -r {cache}; and cat {cache}",
+        "end",
+        "",
+        "complete -c a2km -n __fish_use_subcommand -l version",
+        "complete -c a2km -n __fish_use_subcommand -l debug",
+    ]
+    for name, (options, takes_kernelspec) in commands.items():
+        description = shlex.quote(subcommand_help.get(name, ""))
+        lines.append(
+            f"complete -c a2km -f -n __fish_use_subcommand -a {name} -d {description}"
+        )
+        condition = f"'__fish_seen_subcommand_from {name}'"
+        for option in options:
+            if option.startswith("--"):
+                flag = f"-l {option[2:]}"
+            else:
+                flag = f"-s {option[1:]}"
+            lines.append(f"complete -c a2km -n {condition} {flag}")
+        if takes_kernelspec:
+            lines.append(f"complete -c a2km -n {condition} -a '(__a2km_kernelspecs)'")
+    return "\n".join(lines) + "\n"
+
+
+def script(shell: str, parser: argparse.ArgumentParser) -> str:
+    """Generate the completion script for a shell"""
+    if shell == "bash":
+        return _bash(parser)
+    elif shell == "zsh":
+        return _zsh(parser)
+    elif shell == "fish":
+        return _fish(parser)
+    else:
+        raise ValueError(f"Unsupported shell {shell!r}, choose one of {SHELLS}")
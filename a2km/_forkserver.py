@@ -0,0 +1,454 @@
+"""Prewarmed kernel launcher
+
+This file is copied into kernelspec directories by `a2km prewarm`,
+and run by the kernel's own Python,
+so it must only use the standard library.
+
+Launching a kernel connects to a per-user forkserver
+(starting it if it's not running),
+which has already imported a configured list of modules.
+The forkserver forks a child to run the kernel with the client's
+argv, environment, working directory and stdio.
+The client stays alive as the kernel process Jupyter knows about,
+forwarding signals to the child and exiting with its exit status.
+
+A forkserver is specific to the Python executable, module list, environment,
+and the state of sys.path, so installing packages into the env
+results in a fresh forkserver on the next launch.
+Kernels inherit CPU affinity and resource limits from the forkserver,
+not the client, so those are part of the key too,
+and clients launched with different `taskset`/`prlimit` limits
+(e.g. by `a2km resources`) get their own forkservers.
+Idle forkservers exit after --idle-timeout seconds without kernels.
+
+If anything goes wrong starting or reaching the forkserver,
+the kernel is launched normally.
+"""
+
+from __future__ import annotations
+
+import argparse
+import fcntl
+import hashlib
+import importlib
+import json
+import os
+import resource
+import runpy
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+# environment variables that differ for every kernel launch,
+# and shouldn't result in a new forkserver
+_VOLATILE_ENV_PREFIXES = ("JPY_",)
+_FORWARD_SIGNALS = (
+    signal.SIGINT,
+    signal.SIGTERM,
+    signal.SIGHUP,
+    signal.SIGQUIT,
+    signal.SIGUSR1,
+    signal.SIGUSR2,
+)
+# length header for requests
+_HEADER = struct.Struct("!Q")
+# how long to wait for a new forkserver to start listening
+_START_TIMEOUT = 120
+# how often to check whether sys.path has changed while idle
+_STALE_CHECK_INTERVAL = 10
+
+
+def _runtime_dir() -> str:
+    """The per-user directory for forkserver sockets and logs"""
+    runtime_dir = os.environ.get("A2KM_FORKSERVER_DIR")
+    if not runtime_dir:
+        if os.environ.get("XDG_RUNTIME_DIR"):
+            runtime_dir = os.path.join(os.environ["XDG_RUNTIME_DIR"], "a2km-forkserver")
+        else:
+            runtime_dir = os.path.join(
+                tempfile.gettempdir(), f"a2km-forkserver-{os.getuid()}"
+            )
+    os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+    if os.stat(runtime_dir).st_uid != os.getuid():
+        raise PermissionError(f"{runtime_dir} is not owned by the current user")
+    return runtime_dir
+
+
+def _path_stamp() -> list:
+    """mtimes of sys.path entries, which change when packages are installed"""
+    stamp = []
+    for path in sys.path:
+        try:
+            stamp.append([path, os.stat(path or ".").st_mtime_ns])
+        except OSError:
+            pass
+    return stamp
+
+
+def _limits() -> list:
+    """CPU affinity and resource limits, which forked kernels inherit"""
+    limits: list = []
+    if hasattr(os, "sched_getaffinity"):
+        limits.append(sorted(os.sched_getaffinity(0)))
+    for name in sorted(dir(resource)):
+        if name.startswith("RLIMIT_"):
+            try:
+                limits.append([name, *resource.getrlimit(getattr(resource, name))])
+            except (OSError, ValueError):
+                pass
+    return limits
+
+
+def _server_key(options: argparse.Namespace) -> str:
+    """The key identifying a compatible forkserver"""
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if not key.startswith(_VOLATILE_ENV_PREFIXES)
+    }
+    key_info = [
+        sys.executable,
+        options.module,
+        options.preload,
+        sorted(env.items()),
+        _path_stamp(),
+        _limits(),
+    ]
+    return hashlib.sha256(json.dumps(key_info).encode("utf8")).hexdigest()[:16]
+
+
+def _recv_exactly(conn: socket.socket, n: int) -> bytes:
+    chunks = []
+    while n:
+        chunk = conn.recv(n)
+        if not chunk:
+            raise EOFError("Connection closed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def _exec_directly(options: argparse.Namespace) -> None:
+    """Launch the kernel without a forkserver"""
+    argv = [sys.executable, "-m", options.module] + options.kernel_args
+    os.execv(sys.executable, argv)
+
+
+def _connect(sock_path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _start_server(options: argparse.Namespace, sock_path: str) -> socket.socket:
+    """Start a forkserver and connect to it"""
+    cmd = [
+        sys.executable,
+        os.path.abspath(__file__),
+        f"--serve={sock_path}",
+        f"--preload={options.preload}",
+        f"--idle-timeout={options.idle_timeout}",
+        f"--module={options.module}",
+    ]
+    log_path = sock_path[: -len(".sock")] + ".log"
+    with open(log_path, "ab") as log_file:
+        server = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=log_file,
+            start_new_session=True,
+        )
+    deadline = time.monotonic() + _START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            return _connect(sock_path)
+        except OSError:
+            pass
+        if server.poll() is not None:
+            # exited, but another forkserver may have won the race to start
+            try:
+                return _connect(sock_path)
+            except OSError:
+                raise RuntimeError(
+                    f"forkserver exited with status {server.returncode}, see {log_path}"
+                ) from None
+        time.sleep(0.05)
+    raise TimeoutError(f"forkserver did not start, see {log_path}")
+
+
+def client(options: argparse.Namespace) -> None:
+    """Launch a kernel via the forkserver"""
+    try:
+        sock_path = os.path.join(_runtime_dir(), _server_key(options) + ".sock")
+        try:
+            sock = _connect(sock_path)
+        except OSError:
+            sock = _start_server(options, sock_path)
+        request = json.dumps(
+            {
+                "argv": options.kernel_args,
+                "env": dict(os.environ),
+                "cwd": os.getcwd(),
+            }
+        ).encode("utf8")
+        socket.send_fds(sock, [_HEADER.pack(len(request))], [0, 1, 2])
+        sock.sendall(request)
+        reader = sock.makefile("r")
+        reply = reader.readline().split()
+        if len(reply) != 2 or reply[0] != "pid":
+            raise RuntimeError(f"Unexpected reply from forkserver: {reply}")
+    except Exception as e:
+        print(
+            f"a2km forkserver unavailable, launching kernel directly: {e}",
+            file=sys.stderr,
+        )
+        _exec_directly(options)
+        return
+
+    pid = int(reply[1])
+
+    def forward_signal(signum, frame):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    for signum in _FORWARD_SIGNALS:
+        signal.signal(signum, forward_signal)
+
+    # wait for the kernel to exit
+    reply = reader.readline().split()
+    if len(reply) == 2 and reply[0] == "exit":
+        exit_code = int(reply[1])
+    else:
+        # lost the forkserver
+        forward_signal(signal.SIGKILL, None)
+        exit_code = 1
+    if exit_code < 0:
+        # exit with the same signal as the kernel
+        signal.signal(-exit_code, signal.SIG_DFL)
+        os.kill(os.getpid(), -exit_code)
+    sys.exit(exit_code)
+
+
+def _run_child(conn: socket.socket, fds: list[int], request: dict, module: str) -> None:
+    """Run the kernel in the forked child. Never returns."""
+    exit_code = 1
+    try:
+        os.setsid()
+        conn.close()
+        for signum in _FORWARD_SIGNALS + (signal.SIGCHLD,):
+            signal.signal(signum, signal.SIG_DFL)
+        for target_fd, fd in enumerate(fds):
+            os.dup2(fd, target_fd)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        # don't share random state with every other kernel
+        if "random" in sys.modules:
+            sys.modules["random"].seed()
+        if "numpy.random" in sys.modules:
+            sys.modules["numpy.random"].seed()
+        # like `python -m`, instead of this script's directory
+        if sys.path and sys.path[0] == os.path.dirname(os.path.abspath(__file__)):
+            sys.path[0] = ""
+        sys.argv = [module] + request["argv"]
+        try:
+            runpy.run_module(module, run_name="__main__", alter_sys=True)
+        except SystemExit as e:
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+        else:
+            exit_code = 0
+    except BaseException:
+        import traceback
+
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def serve(options: argparse.Namespace) -> None:
+    """Run the forkserver"""
+    sock_path = options.serve
+    # don't keep the launching kernel's working directory busy
+    os.chdir("/")
+    lock_path = sock_path[: -len(".sock")] + ".lock"
+    with open(lock_path, "w") as lock_file:
+        # only one forkserver may claim the socket
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _connect(sock_path).close()
+        except OSError:
+            pass
+        else:
+            print(f"forkserver already running at {sock_path}", file=sys.stderr)
+            return
+        try:
+            os.unlink(sock_path)
+        except FileNotFoundError:
+            pass
+
+        # preload before listening, so clients wait for it
+        preload: list[str] = [m for m in options.preload.split(",") if m]
+        for module in preload:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                print(f"Failed to preload {module}: {e}", file=sys.stderr)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(sock_path)
+        listener.listen()
+    print(f"forkserver {os.getpid()} listening on {sock_path}", file=sys.stderr)
+    initial_stamp = _path_stamp()
+    next_stale_check = time.monotonic() + _STALE_CHECK_INTERVAL
+
+    # wake up when children exit
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    # pid: connection to the client for that kernel
+    children: dict[int, socket.socket] = {}
+    # children whose clients have gone away
+    orphans: set[int] = set()
+    last_active = time.monotonic()
+    try:
+        while True:
+            waiting_on = [wakeup_r, listener] + [
+                conn for pid, conn in children.items() if pid not in orphans
+            ]
+            readable, _, _ = select.select(waiting_on, [], [], 1)
+            for sock in readable:
+                if sock is wakeup_r:
+                    while True:
+                        try:
+                            if not os.read(wakeup_r, 1024):
+                                break
+                        except BlockingIOError:
+                            break
+                elif sock is listener:
+                    last_active = time.monotonic()
+                    conn, _ = listener.accept()
+                    try:
+                        conn.settimeout(10)
+                        msg, fds, _, _ = socket.recv_fds(conn, _HEADER.size, 3)
+                        if len(fds) != 3:
+                            raise ValueError(f"Expected 3 fds, got {len(fds)}")
+                        (length,) = _HEADER.unpack(msg)
+                        request = json.loads(_recv_exactly(conn, length))
+                        conn.settimeout(None)
+                    except Exception as e:
+                        print(f"Bad request: {e}", file=sys.stderr)
+                        conn.close()
+                        continue
+                    pid = os.fork()
+                    if pid == 0:
+                        signal.set_wakeup_fd(-1)
+                        os.close(wakeup_r)
+                        os.close(wakeup_w)
+                        listener.close()
+                        for other in children.values():
+                            other.close()
+                        _run_child(conn, fds, request, options.module)
+                    for fd in fds:
+                        os.close(fd)
+                    children[pid] = conn
+                    conn.sendall(f"pid {pid}\n".encode())
+                else:
+                    # the client should never send more,
+                    # so this means the client is gone
+                    for pid, conn in children.items():
+                        if conn is sock:
+                            print(f"Client for {pid} is gone", file=sys.stderr)
+                            orphans.add(pid)
+                            try:
+                                os.kill(pid, signal.SIGKILL)
+                            except ProcessLookupError:
+                                pass
+
+            for pid, conn in list(children.items()):
+                waited_pid, status = os.waitpid(pid, os.WNOHANG)
+                if waited_pid:
+                    del children[pid]
+                    orphans.discard(pid)
+                    last_active = time.monotonic()
+                    exit_code = os.waitstatus_to_exitcode(status)
+                    try:
+                        conn.sendall(f"exit {exit_code}\n".encode())
+                    except OSError:
+                        pass
+                    conn.close()
+
+            now = time.monotonic()
+            if children:
+                last_active = now
+            elif now - last_active > options.idle_timeout:
+                print("Exiting after idle timeout", file=sys.stderr)
+                return
+            elif now > next_stale_check:
+                next_stale_check = now + _STALE_CHECK_INTERVAL
+                if _path_stamp() != initial_stamp:
+                    # new kernels will get a new forkserver
+                    print("Exiting after environment change", file=sys.stderr)
+                    return
+    finally:
+        signal.set_wakeup_fd(-1)
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+        listener.close()
+        try:
+            os.unlink(sock_path)
+        except FileNotFoundError:
+            pass
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--preload", default="", help="Comma-separated list of modules to preload"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600,
+        help="Seconds without any kernels before the forkserver exits",
+    )
+    parser.add_argument(
+        "--module", default="ipykernel_launcher", help="The kernel module to run"
+    )
+    parser.add_argument("--serve", metavar="SOCKET", help=argparse.SUPPRESS)
+    parser.add_argument("kernel_args", nargs=argparse.REMAINDER)
+    options = parser.parse_args(argv)
+    if options.kernel_args[:1] == ["--"]:
+        options.kernel_args = options.kernel_args[1:]
+    if options.serve:
+        serve(options)
+    else:
+        client(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""JSON (de)serialization for kernelspecs
+
+Uses orjson for parsing when it's installed,
+which is much faster when reading lots of kernelspecs.
+orjson is stricter than the stdlib json module
+(no NaN or Infinity, integers limited to 64 bits, which it turns into floats),
+so anything it can't parse exactly falls back to json.
+
+Output is always produced by the stdlib json module,
+because orjson can't produce our on-disk format
+(1-space indent, ASCII-escaped strings),
+and output must be byte-identical regardless of which backend is installed
+so that kernel.json diffs stay stable.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from types import ModuleType
+from typing import Any
+
+orjson: ModuleType | None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = ["backend", "dumps", "loads"]
+
+# numbers with this many digits may not fit in 64 bits,
+# and orjson would parse them as floats
+_LONG_NUMBER = re.compile(r"\d{19}")
+_LONG_NUMBER_BYTES = re.compile(rb"\d{19}")
+
+
+def backend() -> str:
+    """The name of the backend used for parsing"""
+    if orjson is None:
+        return "json"
+    return "orjson"
+
+
+def loads(data: bytes | str) -> Any:
+    """Parse JSON from bytes or str"""
+    if orjson is not None:
+        if isinstance(data, str):
+            has_long_number = _LONG_NUMBER.search(data) is not None
+        else:
+            has_long_number = _LONG_NUMBER_BYTES.search(data) is not None
+        if not has_long_number:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # e.g. NaN, which json accepts
+                pass
+    return json.loads(data)
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> str:
+    """Serialize a kernelspec in our on-disk format
+
+    Keys are not sorted by default,
+    that way we should _usually_ preserve read order.
+    """
+    return json.dumps(obj, sort_keys=sort_keys, indent=1)
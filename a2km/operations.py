@@ -1,24 +1,39 @@
 from __future__ import annotations
 
-import copy
+import ast
+import builtins
+import errno
+import fnmatch
+import hashlib
 import io
-import json
 import logging
 import os
+import random
+import re
 import secrets
 import shlex
 import shutil
+import socket
+import stat
 import sys
-from collections.abc import Generator
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Generator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
-from subprocess import check_output
+from subprocess import DEVNULL, PIPE, Popen, check_output, run
 from tempfile import TemporaryDirectory
-from typing import TYPE_CHECKING, Any
-from unittest import mock
+from typing import TYPE_CHECKING, Any, NamedTuple
 
 from jupyter_core import paths
 
+if sys.platform != "win32":
+    import fcntl
+
+from a2km import _serialize
+
 if TYPE_CHECKING:
     import io
 
@@ -27,15 +42,15 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 
 
-@contextmanager
-def _patched_path() -> Generator[None]:
-    """Patch jupyter_path with prefixes on $PATH
+def _jupyter_path(*subdirs: str) -> list[str]:
+    """jupyter_path, plus prefixes on $PATH
 
     so all kernelspecs are likely to be found,
-    even when a2km is in its own env, e.g. with uvx/pipx
+    even when a2km is in its own env, e.g. with uvx/pipx.
+    The extra prefixes are lowest priority, just ahead of the system-wide paths.
+    jupyter_core isn't patched, so this is safe to call from multiple threads.
     """
-    system_jupyter_path = paths.SYSTEM_JUPYTER_PATH
-    current_jupyter_path = paths.jupyter_path()
+    jupyter_path = paths.jupyter_path()
     extra_path: list[str] = []
     for bin in (os.environ.get("PATH") or os.defpath).split(os.pathsep):
         bin_path = Path(bin)
@@ -45,49 +60,340 @@ def _patched_path() -> Generator[None]:
             jupyter_dir = prefix / "share" / "jupyter"
             if (
                 jupyter_dir.exists()
-                and str(jupyter_dir) not in current_jupyter_path
+                and str(jupyter_dir) not in jupyter_path
                 and str(jupyter_dir) not in extra_path
             ):
                 extra_path.append(str(jupyter_dir))
-    # patch into SYSTEM_JUPYTER_PATH
-    # so it's lowest priority
-    with mock.patch(
-        "jupyter_core.paths.SYSTEM_JUPYTER_PATH", extra_path + system_jupyter_path
+    # insert before the system-wide paths, which jupyter_path puts last
+    system_jupyter_path = paths.SYSTEM_JUPYTER_PATH
+    i = len(jupyter_path)
+    while i > 0 and jupyter_path[i - 1] in system_jupyter_path:
+        i -= 1
+    jupyter_path[i:i] = extra_path
+    return [os.path.join(p, *subdirs) for p in jupyter_path]
+
+
+_CATALOG_NAME = ".a2km-catalog.json"
+_NS_PER_S = 1_000_000_000
+
+
+def build_catalog(kernels_dir: _PathLike) -> Path:
+    """Build a packed catalog of all kernelspecs in a kernels directory
+
+    The catalog is used instead of visiting each kernelspec
+    as long as the directory's mtime hasn't changed.
+    Changes to kernel.json files made outside a2km
+    require rebuilding the catalog.
+
+    Some filesystems (e.g. NFSv3, Lustre) store mtimes in whole seconds,
+    so the directory is only scanned after the second of its mtime has passed,
+    otherwise a kernelspec added later in the same second would go unnoticed.
+    """
+    kernels_dir = Path(kernels_dir)
+    catalog_path = kernels_dir / _CATALOG_NAME
+    # create the file before recording the directory mtime,
+    # since adding it to the directory changes the mtime
+    catalog_path.touch()
+    mtime_ns = kernels_dir.stat().st_mtime_ns
+    built_ns = time.time_ns()
+    if built_ns // _NS_PER_S <= mtime_ns // _NS_PER_S:
+        time.sleep((mtime_ns // _NS_PER_S + 1) - built_ns / _NS_PER_S)
+        built_ns = time.time_ns()
+    kernelspecs = {}
+    for kernelspec_path in sorted(kernels_dir.iterdir()):
+        if kernelspec_path.name.startswith("."):
+            continue
+        try:
+            data = (kernelspec_path / "kernel.json").read_bytes()
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        try:
+            kernelspecs[kernelspec_path.name] = _serialize.loads(data)
+        except ValueError as e:
+            log.warning("Skipping invalid kernelspec %s: %s", kernelspec_path, e)
+    catalog = {
+        "version": 1,
+        "mtime_ns": mtime_ns,
+        "built_ns": built_ns,
+        "kernelspecs": kernelspecs,
+    }
+    log.info("Writing catalog of %i kernelspecs to %s", len(kernelspecs), catalog_path)
+    # write in-place, because renaming a new file into place
+    # would change the directory mtime.
+    # A partially-written catalog fails to parse, and is ignored.
+    with catalog_path.open("w") as f:
+        f.write(_serialize.dumps(catalog))
+    return catalog_path
+
+
+def _load_catalog(kernels_dir: Path) -> dict[str, dict] | None:
+    """Load the kernelspecs from a kernels directory's catalog
+
+    Returns None if there is no catalog, or it is out of date.
+    """
+    try:
+        data = (kernels_dir / _CATALOG_NAME).read_bytes()
+        mtime_ns = kernels_dir.stat().st_mtime_ns
+    except OSError:
+        return None
+    try:
+        catalog = _serialize.loads(data)
+    except ValueError:
+        log.debug("Ignoring invalid catalog in %s", kernels_dir)
+        return None
+    if not (
+        isinstance(catalog, dict)
+        and isinstance(catalog.get("kernelspecs"), dict)
+        and isinstance(catalog.get("built_ns"), int)
     ):
-        yield
+        log.debug("Ignoring invalid catalog in %s", kernels_dir)
+        return None
+    if catalog.get("mtime_ns") != mtime_ns:
+        log.debug("Ignoring stale catalog in %s", kernels_dir)
+        return None
+    if mtime_ns // _NS_PER_S >= catalog["built_ns"] // _NS_PER_S:
+        # changes in the same second as the build
+        # may not change a coarse directory mtime
+        log.debug("Ignoring catalog built too soon after changes in %s", kernels_dir)
+        return None
+    return catalog["kernelspecs"]
 
 
-def locate(kernelspec: _PathLike) -> Path:
-    """Resolve a kernelspec name to a path"""
+def _invalidate_catalog(kernels_dir: Path) -> None:
+    """Remove a kernels directory's catalog, if there is one"""
+    try:
+        (kernels_dir / _CATALOG_NAME).unlink()
+    except FileNotFoundError:
+        pass
+    else:
+        log.info("Removed catalog in %s, rebuild it with build-catalog", kernels_dir)
 
+
+def _find_kernelspec(kernelspec: _PathLike) -> tuple[Path, dict | None]:
+    """Resolve a kernelspec name to a path
+
+    Also returns the kernelspec itself, if it was loaded from a catalog.
+    """
     kernelspec_path = Path(kernelspec)
     if kernelspec_path.exists():
-        return kernelspec_path
+        return kernelspec_path, None
 
-    with _patched_path():
-        kernels_path = paths.jupyter_path("kernels")
+    kernels_path = _jupyter_path("kernels")
     for kernels_dir in kernels_path:
         kernelspec_path = Path(kernels_dir) / kernelspec
+        if kernelspec_path.name == str(kernelspec):
+            catalog = _load_catalog(Path(kernels_dir))
+            if catalog is not None:
+                if kernelspec_path.name in catalog:
+                    return kernelspec_path.absolute(), catalog[kernelspec_path.name]
+                continue
         if kernelspec_path.exists():
-            return kernelspec_path.absolute()
+            return kernelspec_path.absolute(), None
 
     raise FileNotFoundError(f"No {kernelspec} found on {os.pathsep.join(kernels_path)}")
 
 
+def locate(kernelspec: _PathLike) -> Path:
+    """Resolve a kernelspec name to a path"""
+    return _find_kernelspec(kernelspec)[0]
+
+
+def _kernels_dirs() -> list[Path]:
+    """All kernels directories on the search path, highest priority first"""
+    return [Path(d) for d in _jupyter_path("kernels")]
+
+
+def _list_kernelspecs(kernels_dir: Path) -> dict[str, dict | None]:
+    """List the kernelspecs in a kernels directory
+
+    Returns a dict of kernelspec names to kernelspecs,
+    if they were loaded from a catalog, otherwise None.
+    """
+    catalog = _load_catalog(kernels_dir)
+    if catalog is not None:
+        return dict(catalog)
+    kernelspecs: dict[str, dict | None] = {}
+    try:
+        entries = sorted(os.scandir(kernels_dir), key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return kernelspecs
+    for entry in entries:
+        if entry.name.startswith(".") or not entry.is_dir():
+            continue
+        if os.path.exists(os.path.join(entry.path, "kernel.json")):
+            kernelspecs[entry.name] = None
+    return kernelspecs
+
+
+def _parse_selector(selector: str) -> tuple[str, str]:
+    key, sep, value = selector.partition("=")
+    if not sep or not key:
+        raise ValueError(
+            f"Selectors must have the form key=value (e.g. language=python), got {selector!r}"
+        )
+    return key, value
+
+
+def _matches(spec: dict, selectors: list[tuple[str, str]]) -> bool:
+    """Whether a kernelspec matches all selectors"""
+    for key, pattern in selectors:
+        if key == "env":
+            # env=KEY selects kernelspecs that set KEY
+            if pattern not in spec.get("env", {}):
+                return False
+        elif key == "argv0":
+            argv = spec.get("argv") or [""]
+            if not fnmatch.fnmatchcase(Path(argv[0]).name, pattern):
+                return False
+        else:
+            value = spec.get(key)
+            if not isinstance(value, str) or not fnmatch.fnmatchcase(value, pattern):
+                return False
+    return True
+
+
+def find_kernelspecs(
+    pattern: str = "*",
+    where: list[str] | None = None,
+    kernels_dirs: list[_PathLike] | None = None,
+    unique: bool = True,
+    follow_symlinks: bool = True,
+) -> list[Path]:
+    """Find kernelspecs matching a glob pattern and selectors
+
+    The search path (or kernels_dirs, if given) is scanned once.
+    If unique is True, like locate,
+    only the highest-priority kernelspec with a given name is found.
+    Otherwise, matching kernelspecs in every kernels directory are found.
+    If follow_symlinks is False, symlinked kernelspec directories and kernel.json files
+    are skipped, e.g. when changing other users' kernelspecs as root.
+
+    Selectors have the form key=pattern, where key can be:
+
+    - argv0: the name of the executable (e.g. argv0=conda)
+    - env: the kernelspec sets the given environment variable (e.g. env=SPARK_HOME)
+    - any top-level field (e.g. language=python)
+    """
+    selectors = [_parse_selector(selector) for selector in where or []]
+    dirs = kernels_dirs if kernels_dirs is not None else _kernels_dirs()
+    found: list[Path] = []
+    # names already seen in higher-priority directories,
+    # whether or not they matched, since they shadow the rest
+    seen: builtins.set[str] = builtins.set()
+    for kernels_dir in map(Path, dirs):
+        kernels_dir = kernels_dir.absolute()
+        for name, spec in _list_kernelspecs(kernels_dir).items():
+            if unique:
+                if name in seen:
+                    continue
+                seen.add(name)
+            if not fnmatch.fnmatchcase(name, pattern):
+                continue
+            kernelspec_path = kernels_dir / name
+            if not follow_symlinks:
+                if os.sep in name or name.startswith("."):
+                    log.warning("Skipping invalid kernelspec name %r", name)
+                    continue
+                if (
+                    kernelspec_path.is_symlink()
+                    or (kernelspec_path / "kernel.json").is_symlink()
+                ):
+                    log.warning("Skipping symlinked kernelspec %s", kernelspec_path)
+                    continue
+            if selectors:
+                if spec is None:
+                    try:
+                        spec = _read_kernelspec(kernelspec_path)
+                    except (OSError, ValueError) as e:
+                        log.warning("Skipping %s: %s", kernelspec_path, e)
+                        continue
+                if not _matches(spec, selectors):
+                    continue
+            found.append(kernelspec_path)
+    return found
+
+
+# where jupyter_core puts per-user data, relative to home
+_USER_DATA_DIRS = [
+    Path(".local", "share", "jupyter"),
+    Path("Library", "Jupyter"),
+]
+
+
+def user_kernels_dirs(users_root: _PathLike) -> dict[str, Path]:
+    """Find the per-user kernels directories of all users
+
+    users_root is the directory containing home directories (e.g. /home).
+    Returns a dict of user names (home directory names) to kernels directories.
+    """
+    kernels_dirs = {}
+    for home in sorted(Path(users_root).iterdir()):
+        for data_dir in _USER_DATA_DIRS:
+            kernels_dir = home / data_dir / "kernels"
+            try:
+                if kernels_dir.is_dir():
+                    if not kernels_dir.resolve().is_relative_to(home.resolve()):
+                        # don't follow symlinks out of a user's home
+                        log.warning("Skipping %s, outside %s", kernels_dir, home)
+                        break
+                    kernels_dirs[home.name] = kernels_dir
+                    break
+            except PermissionError as e:
+                log.warning("Skipping %s: %s", home, e)
+                break
+    return kernels_dirs
+
+
+def map_kernelspecs(
+    func: Callable[..., Any],
+    kernelspecs: list[Path],
+    *args: Any,
+    max_workers: int | None = None,
+    **kwargs: Any,
+) -> dict[Path, BaseException | None]:
+    """Apply an operation to many kernelspecs in parallel
+
+    Calls func(kernelspec, *args, **kwargs) for each kernelspec.
+    Returns a dict of each kernelspec to the exception raised, if any.
+    """
+    results: dict[Path, BaseException | None] = {}
+    if not kernelspecs:
+        return results
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            kernelspec: pool.submit(func, kernelspec, *args, **kwargs)
+            for kernelspec in kernelspecs
+        }
+        for kernelspec, future in futures.items():
+            results[kernelspec] = future.exception()
+    return results
+
+
 def show(kernelspec: _PathLike, json_output: bool = False) -> None:
     """Display information about a kernelspec"""
-    kernelspec_path = locate(kernelspec)
-    kernelspec_json = kernelspec_path / "kernel.json"
-    with kernelspec_json.open() as f:
-        spec = json.load(f)
+    kernelspec_path, spec = _find_kernelspec(kernelspec)
+    if spec is None:
+        spec = _read_kernelspec(kernelspec_path)
     if json_output:
-        json.dump(spec, sys.stdout, indent=1)
+        sys.stdout.write(_serialize.dumps(spec))
         return
     print(
         f"Kernel: {kernelspec_path.name} ({spec.get('display_name', '<no display name>')})"
     )
     print(f"  path: {kernelspec_path}")
     print(f"  argv: {shlex.join(spec['argv'])}")
+    if spec.get("env"):
+        print("  env:")
+        for key, value in spec["env"].items():
+            print(f"    {key}={value}")
+    limits = spec.get("metadata", {}).get("a2km", {}).get("resources")
+    if limits:
+        summary = " ".join(
+            f"{key}={limits[key]}"
+            for key in ("threads", "cpus", "memory")
+            if key in limits
+        )
+        print(f"  resources: {summary}")
 
 
 def rename(kernelspec: _PathLike, new_name: str) -> Path:
@@ -100,24 +406,63 @@ def rename(kernelspec: _PathLike, new_name: str) -> Path:
         dest = dest.absolute()
     log.info("Renaming %s -> %s", kernelspec, dest)
     kernelspec.rename(dest)
+    _relocate_env(dest, kernelspec)
     return dest
 
 
+def _replace_path_prefix(value: str, old: str, new: str) -> str:
+    """Replace a path, or the start of a path inside it, with new"""
+    if value == old:
+        return new
+    if value.startswith(old + os.sep):
+        return new + value[len(old) :]
+    return value
+
+
+def _relocate_env(kernelspec: Path, old_path: Path) -> None:
+    """Update env variables pointing inside a kernelspec's old location
+
+    e.g. the PYTHONPYCACHEPREFIX set by `env-kernel --precompile`,
+    after the kernelspec is moved or copied.
+    """
+    old, new = str(old_path.absolute()), str(kernelspec.absolute())
+
+    def edit(spec):
+        env = spec.get("env", {})
+        for key, value in env.items():
+            if isinstance(value, str):
+                env[key] = _replace_path_prefix(value, old, new)
+
+    _update_kernelspec(kernelspec, edit)
+
+
 @contextmanager
-def _atomic_write(path: Path) -> Generator[io.TextIOWrapper]:
+def _atomic_write(
+    path: Path, precondition: Callable[[], None] | None = None
+) -> Generator[io.TextIOWrapper]:
     """Open a file for atomic writing
 
     Completes write to a temporary file before
     overwriting original file
 
     avoids corrupting files with failed or partial writes
+
+    If given, precondition is called immediately before overwriting the file,
+    while holding a lock on its directory,
+    and may raise to abort the write.
     """
     write_path = path.with_suffix(path.suffix + ".a2km." + secrets.token_urlsafe(3))
     log.debug("Writing  temporary file %s", write_path)
     try:
         with write_path.open("w") as f:
             yield f
-        write_path.rename(path)
+            _copy_ownership(path, f.fileno())
+        if precondition is None:
+            write_path.rename(path)
+        else:
+            with _dir_lock(path.parent):
+                precondition()
+                write_path.rename(path)
     finally:
         try:
             log.debug("Removing temporary file %s", write_path)
@@ -126,102 +471,769 @@ def _atomic_write(path: Path) -> Generator[io.TextIOWrapper]:
             pass
 
 
-def _write_kernelspec(kernelspec: _PathLike, new_spec: dict) -> None:
+def _copy_ownership(path: Path, fd: int) -> None:
+    """Give a replacement file the permissions and owner of the file it replaces
+
+    so rewriting another user's files (e.g. as root) doesn't change them.
+    """
+    if not hasattr(os, "fchown"):
+        # Windows
+        return
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return
+    os.fchmod(fd, stat.S_IMODE(st.st_mode))
+    new_st = os.fstat(fd)
+    if (new_st.st_uid, new_st.st_gid) != (st.st_uid, st.st_gid):
+        try:
+            os.fchown(fd, st.st_uid, st.st_gid)
+        except PermissionError as e:
+            log.warning("Could not preserve owner of %s: %s", path, e)
+
+
+def _replace_file(path: Path, src: Path) -> None:
+    """Replace a file with a copy of src, without writing to the file itself
+
+    Like _atomic_write, the copy is renamed over the file,
+    so other hardlinks to it (e.g. from dedupe) are left unchanged.
+    src may be path itself, to break its links.
+    """
+    tmp_path = path.with_name(f"{path.name}.a2km.{secrets.token_urlsafe(3)}")
+    try:
+        shutil.copyfile(src, tmp_path)
+        with tmp_path.open("rb") as f:
+            _copy_ownership(path, f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+@contextmanager
+def _dir_lock(path: Path) -> Generator[None]:
+    """Hold an exclusive lock on a directory, where possible
+
+    Only used briefly around check-and-replace,
+    so writers never wait on each other's edits.
+
+    The lock is only best-effort and host-local:
+    on NFS, flock on a directory doesn't exclude writers on other hosts,
+    and where flock isn't supported (Windows, Lustre without -o flock)
+    no lock is held. The stamp check before replacing still catches
+    most conflicting writes there, but not ones racing in between.
+    """
+    if sys.platform == "win32":
+        yield
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            log.debug("Not locking %s: %s", path, e)
+        yield
+    finally:
+        os.close(fd)
+
+
+class _WriteConflict(Exception):
+    """kernel.json changed since it was read"""
+
+
+def _stamp(st: os.stat_result) -> tuple[int, int, int]:
+    """Identify a version of a file
+
+    Atomic writes always replace the inode,
+    so this changes even if mtime resolution is coarse.
+    """
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _write_kernelspec(
+    kernelspec: _PathLike,
+    new_spec: dict | str,
+    expected_stamp: tuple[int, int, int] | None = None,
+) -> None:
+    """Write a kernelspec
+
+    new_spec may be the spec itself or its already-serialized form
+    (as produced by `_serialize.dumps`), to avoid serializing twice.
+
+    If expected_stamp is given, raises _WriteConflict
+    instead of writing if kernel.json has changed since it was read.
+    """
     kernel_json_path = locate(kernelspec) / "kernel.json"
     log.info("Updating %s", kernel_json_path)
-    with _atomic_write(kernel_json_path) as f:
-        # do not sort keys,
-        # that way we should _usually_ preserve read order
-        json.dump(new_spec, f, sort_keys=False, indent=1)
+    if isinstance(new_spec, dict):
+        new_spec = _serialize.dumps(new_spec)
+
+    precondition = None
+    if expected_stamp is not None:
+
+        def precondition():
+            if _stamp(kernel_json_path.stat()) != expected_stamp:
+                raise _WriteConflict(f"{kernel_json_path} changed since it was read")
+
+    try:
+        with _atomic_write(kernel_json_path, precondition) as f:
+            f.write(new_spec)
+    finally:
+        _spec_cache.discard(kernel_json_path.absolute())
+    # changing kernel.json doesn't change the kernels dir mtime,
+    # so the catalog wouldn't notice it's stale
+    _invalidate_catalog(kernel_json_path.parent.parent)
+
+
+def _copy_spec(obj: Any) -> Any:
+    """Deep copy a parsed kernelspec (only JSON types)"""
+    if isinstance(obj, dict):
+        return {key: _copy_spec(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_copy_spec(item) for item in obj]
+    return obj
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _SpecCache:
+    """LRU cache of parsed kernel.json files
+
+    Entries are keyed by path and only used while the file's stamp
+    (mtime, size, inode) is unchanged,
+    so files changed by other processes are re-read.
+    Callers get their own copy of each spec, so they can modify it.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Path, tuple[tuple[int, int, int], dict]] = (
+            OrderedDict()
+        )
+
+    def get(self, path: Path, stamp: tuple[int, int, int]) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(path)
+            spec = entry[1]
+        return _copy_spec(spec)
+
+    def put(self, path: Path, stamp: tuple[int, int, int], spec: dict) -> None:
+        spec = _copy_spec(spec)
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._entries[path] = (stamp, spec)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, path: Path) -> None:
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def resize(self, maxsize: int) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+
+_spec_cache = _SpecCache(maxsize=1024)
+
+
+def cache_info() -> CacheInfo:
+    """Hits and misses of the cache of parsed kernelspecs, like functools.lru_cache"""
+    return _spec_cache.info()
+
+
+def cache_clear() -> None:
+    """Empty the cache of parsed kernelspecs, and reset its statistics"""
+    _spec_cache.clear()
+
+
+def cache_resize(maxsize: int) -> None:
+    """Set the number of parsed kernelspecs to cache (0 disables the cache)"""
+    _spec_cache.resize(maxsize)
+
+
+def _read_kernelspec_stamped(
+    kernelspec: _PathLike,
+) -> tuple[dict, tuple[int, int, int]]:
+    """Read a kernelspec, and the stamp of the version that was read
+
+    Uses the cache of parsed kernelspecs, if kernel.json hasn't changed.
+    """
+    kernel_json_path = locate(kernelspec).absolute() / "kernel.json"
+    stamp = _stamp(kernel_json_path.stat())
+    spec = _spec_cache.get(kernel_json_path, stamp)
+    if spec is not None:
+        return spec, stamp
+    with kernel_json_path.open("rb") as f:
+        stamp = _stamp(os.fstat(f.fileno()))
+        data = f.read()
+    spec = _serialize.loads(data)
+    _spec_cache.put(kernel_json_path, stamp, spec)
+    return spec, stamp
 
 
 def _read_kernelspec(kernelspec: _PathLike):
-    kernelspec_path = locate(kernelspec)
-    kernel_json_path = kernelspec_path / "kernel.json"
-    with kernel_json_path.open() as f:
-        return json.load(f)
+    return _read_kernelspec_stamped(kernelspec)[0]
+
+
+# how many times to retry an edit after conflicting writes
+_UPDATE_ATTEMPTS = 50
+
+
+def _update_kernelspec(kernelspec: _PathLike, edit: Callable[[dict], None]) -> bool:
+    """Apply an edit to a kernelspec, without losing concurrent updates
+
+    edit is called with the spec, and modifies it in-place.
+    If kernel.json is changed by someone else before the result is written,
+    the edit is applied again to the new contents,
+    so concurrent edits of the same kernelspec are all kept.
+
+    Returns whether the kernelspec was changed.
+    """
+    kernelspec = locate(kernelspec)
+    for attempt in range(_UPDATE_ATTEMPTS):
+        spec, stamp = _read_kernelspec_stamped(kernelspec)
+        # compare serialized forms instead of deep-copying the spec
+        before = _serialize.dumps(spec)
+        edit(spec)
+        after = _serialize.dumps(spec)
+        if after == before:
+            log.info("No change to %s", kernelspec)
+            return False
+        try:
+            _write_kernelspec(kernelspec, after, expected_stamp=stamp)
+        except _WriteConflict as e:
+            log.info("%s, retrying", e)
+            # jitter, so competing writers don't keep colliding
+            time.sleep(random.uniform(0, 0.001 * (attempt + 1)))
+        else:
+            return True
+    raise RuntimeError(
+        f"Failed to update {kernelspec} after {_UPDATE_ATTEMPTS} conflicting writes"
+    )
 
 
 def set(kernelspec: _PathLike, to_set: dict[str, Any]) -> None:
     """Set fields in a kernelspec file"""
-    kernelspec = locate(kernelspec)
-    spec = _read_kernelspec(kernelspec)
-    before = copy.deepcopy(spec)
-    spec.update(to_set)
-    if spec != before:
-        _write_kernelspec(kernelspec, spec)
-    else:
-        log.info("No change to %s", kernelspec)
+
+    def edit(spec):
+        spec.update(to_set)
+
+    _update_kernelspec(kernelspec, edit)
 
 
 def add_env(kernelspec: _PathLike, new_env: dict[str, str]) -> None:
     """Add environment variables to a kernelspec"""
-    kernelspec = locate(kernelspec)
-    spec = _read_kernelspec(kernelspec)
-    if "env" not in spec:
-        spec["env"] = {}
-    before_env = spec["env"].copy()
-    spec["env"].update(new_env)
-    if before_env != spec["env"]:
-        _write_kernelspec(kernelspec, spec)
-    else:
-        log.info("No change to %s", kernelspec)
+
+    def edit(spec):
+        spec.setdefault("env", {}).update(new_env)
+
+    _update_kernelspec(kernelspec, edit)
 
 
 def remove_env(kernelspec: _PathLike, env_keys: list[str]) -> None:
     """Remove environment variables from a kernelspec"""
-    kernelspec = locate(kernelspec)
-    spec = _read_kernelspec(kernelspec)
-    if "env" not in spec:
-        log.info("No change to %s", kernelspec)
-        return
-    env = spec["env"]
-    any_removed = False
-    for key in env_keys:
-        if key in env:
-            any_removed = True
-            del env[key]
-
-    if any_removed:
-        _write_kernelspec(kernelspec, spec)
-    else:
-        log.info("No change to %s", kernelspec)
 
+    def edit(spec):
+        env = spec.get("env", {})
+        for key in env_keys:
+            env.pop(key, None)
 
-def add_argv(kernelspec: _PathLike, to_add: list[str]) -> None:
-    """Add cli arguments to a kernelspec"""
-    kernelspec = locate(kernelspec)
-    spec = _read_kernelspec(kernelspec)
-    if "argv" not in spec:
-        raise KeyError(f"kernelspec {kernelspec} doesn't have 'argv'")
-    spec["argv"].extend(to_add)
-    log.info("New argv: %s", shlex.join(spec["argv"]))
-    _write_kernelspec(kernelspec, spec)
+    _update_kernelspec(kernelspec, edit)
+
+
+def add_argv(kernelspec: _PathLike, to_add: list[str], prepend: bool = False) -> None:
+    """Add cli arguments to a kernelspec
+
+    If prepend is True, arguments are added at the beginning of argv,
+    e.g. to launch the kernel via a wrapper command.
+    """
+
+    def edit(spec):
+        if "argv" not in spec:
+            raise KeyError(f"kernelspec {kernelspec} doesn't have 'argv'")
+        if prepend:
+            spec["argv"][:0] = to_add
+        else:
+            spec["argv"].extend(to_add)
+        log.info("New argv: %s", shlex.join(spec["argv"]))
+
+    _update_kernelspec(kernelspec, edit)
 
 
 def remove_argv(kernelspec: _PathLike, to_remove: list[str]) -> None:
     """Remove cli arguments from a kernelspec"""
+
+    def edit(spec):
+        if "argv" not in spec:
+            raise KeyError(f"kernelspec {kernelspec} doesn't have 'argv'")
+        any_removed = False
+        for arg in to_remove:
+            try:
+                spec["argv"].remove(arg)
+            except ValueError:
+                pass
+            else:
+                any_removed = True
+        if any_removed:
+            log.info("New argv: %s", shlex.join(spec["argv"]))
+
+    _update_kernelspec(kernelspec, edit)
+
+
+# thread pool sizes of common numerical libraries
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+_BYTE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def _parse_bytes(size: str | int) -> int:
+    """Parse a size like '8G' to bytes"""
+    match = re.fullmatch(r"(\d+)\s*([KMGT]?)i?B?", str(size).strip(), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Not a size: {size!r}, expected e.g. '512M' or '8G'")
+    return int(match.group(1)) * _BYTE_UNITS[match.group(2).upper()]
+
+
+def _count_cpus(cpus: str) -> int:
+    """Count the CPUs in a taskset-style list, e.g. '0-3,8' is 5"""
+    count = 0
+    for part in cpus.split(","):
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", part.strip())
+        if match is None:
+            raise ValueError(f"Not a CPU list: {cpus!r}, expected e.g. '0-3,8'")
+        start, end = match.groups()
+        count += int(end) - int(start) + 1 if end else 1
+    return count
+
+
+def _clear_resources(spec: dict) -> None:
+    """Undo the changes recorded by a previous call to resources"""
+    recorded = spec.get("metadata", {}).get("a2km", {}).pop("resources", None)
+    if not recorded:
+        return
+    env = spec.get("env", {})
+    # values from before resources set them (null if unset)
+    previous_env = recorded.get("previous_env", {})
+    for key, value in recorded.get("env", {}).items():
+        # leave variables that have since been changed by other means
+        if env.get(key) == value:
+            if previous_env.get(key) is None:
+                del env[key]
+            else:
+                env[key] = previous_env[key]
+    if "env" in spec and not spec["env"]:
+        del spec["env"]
+    preamble = recorded.get("argv", [])
+    if preamble and spec.get("argv", [])[: len(preamble)] == preamble:
+        del spec["argv"][: len(preamble)]
+    a2km_metadata = spec["metadata"]["a2km"]
+    if not a2km_metadata:
+        del spec["metadata"]["a2km"]
+    if not spec["metadata"]:
+        del spec["metadata"]
+
+
+def resources(
+    kernelspec: _PathLike,
+    threads: int | None = None,
+    cpus: str | None = None,
+    memory: str | int | None = None,
+    clear: bool = False,
+) -> None:
+    """Limit the CPUs, threads and memory a kernel uses
+
+    threads sets the thread pool size of OpenMP, MKL and OpenBLAS
+    (default: the number of cpus, if given).
+    cpus is a CPU list for `taskset -c` (e.g. '0-3'),
+    and memory limits the kernel's address space with `prlimit --as` (e.g. '8G').
+
+    The changes (and the variables they replaced) are recorded in the kernelspec's metadata,
+    so they are replaced by the next call, and undone with clear=True.
+    Prewarmed kernels are forked from a forkserver with the same limits,
+    so kernelspecs sharing an env don't share each other's limits.
+    """
+    if not clear and threads is None and cpus is None and memory is None:
+        raise ValueError("Specify threads, cpus, or memory (or clear)")
+    if threads is None and cpus is not None:
+        threads = _count_cpus(cpus)
+    if threads is not None and threads < 1:
+        raise ValueError(f"threads must be at least 1, not {threads}")
+
+    settings: dict[str, Any] = {}
+    new_env: dict[str, str] = {}
+    preamble: list[str] = []
+    if threads is not None:
+        settings["threads"] = threads
+        new_env = {key: str(threads) for key in _THREAD_ENV}
+    if cpus is not None:
+        _count_cpus(cpus)
+        settings["cpus"] = cpus
+        preamble += ["taskset", "-c", cpus]
+    if memory is not None:
+        settings["memory"] = str(memory)
+        preamble += ["prlimit", f"--as={_parse_bytes(memory)}"]
+    for cmd in ("taskset", "prlimit"):
+        if cmd in preamble and not shutil.which(cmd):
+            log.warning("%s not found, it must be available where kernels run", cmd)
+
+    def edit(spec):
+        if "argv" not in spec:
+            raise KeyError(f"kernelspec {kernelspec} doesn't have 'argv'")
+        _clear_resources(spec)
+        if clear:
+            return
+        env = spec.setdefault("env", {})
+        previous_env = {key: env.get(key) for key in new_env}
+        env.update(new_env)
+        spec["argv"][:0] = preamble
+        spec.setdefault("metadata", {}).setdefault("a2km", {})["resources"] = {
+            **settings,
+            "env": new_env,
+            "previous_env": previous_env,
+            "argv": preamble,
+        }
+
+    _update_kernelspec(kernelspec, edit)
+
+
+_FORKSERVER_SCRIPT = "a2km_forkserver.py"
+_KERNEL_MODULES = {"ipykernel_launcher", "ipykernel"}
+
+
+def _strip_forkserver(argv: list[str]) -> list[str]:
+    """Restore an argv rewritten by prewarm to launch the kernel module directly"""
+    for i, arg in enumerate(argv):
+        if arg.endswith("/" + _FORKSERVER_SCRIPT):
+            break
+    else:
+        return argv
+    module = "ipykernel_launcher"
+    end = argv.index("--", i)
+    for arg in argv[i + 1 : end]:
+        if arg.startswith("--module="):
+            module = arg.partition("=")[2]
+    return argv[:i] + ["-m", module] + argv[end + 1 :]
+
+
+def prewarm(
+    kernelspec: _PathLike,
+    preload: list[str] | None = None,
+    idle_timeout: float = 600,
+    disable: bool = False,
+) -> None:
+    """Launch a kernelspec via a forkserver with preloaded modules
+
+    The first launch starts a per-user forkserver,
+    which imports ipykernel and the modules in `preload`.
+    Subsequent launches fork from it instead of starting a new Python process,
+    skipping the cost of those imports.
+    The forkserver exits after `idle_timeout` seconds without kernels,
+    and a new one is started if the env changes.
+
+    disable=True restores launching the kernel directly.
+    """
     kernelspec = locate(kernelspec)
-    spec = _read_kernelspec(kernelspec)
-    if "argv" not in spec:
-        raise KeyError(f"kernelspec {kernelspec} doesn't have 'argv'")
-    any_removed = False
-    for arg in to_remove:
-        try:
-            spec["argv"].remove(arg)
-        except ValueError:
-            pass
+    script_path = kernelspec / _FORKSERVER_SCRIPT
+    preload = ["ipykernel.kernelapp"] + [
+        m for m in preload or [] if m != "ipykernel.kernelapp"
+    ]
+
+    def edit(spec):
+        if "argv" not in spec:
+            raise KeyError(f"kernelspec {kernelspec} doesn't have 'argv'")
+        argv = _strip_forkserver(spec["argv"])
+        if disable:
+            spec["argv"] = argv
+            return
+        for i, arg in enumerate(argv[1:-1], 1):
+            if arg == "-m" and argv[i + 1] in _KERNEL_MODULES:
+                break
         else:
-            any_removed = True
-    if any_removed:
+            raise ValueError(
+                f"Don't know how to prewarm {kernelspec}, argv doesn't run {' or '.join(sorted(_KERNEL_MODULES))}: {shlex.join(argv)}"
+            )
+        spec["argv"] = (
+            argv[:i]
+            + [
+                "{resource_dir}/" + _FORKSERVER_SCRIPT,
+                f"--preload={','.join(preload)}",
+                f"--idle-timeout={idle_timeout:g}",
+                f"--module={argv[i + 1]}",
+                "--",
+            ]
+            + argv[i + 2 :]
+        )
         log.info("New argv: %s", shlex.join(spec["argv"]))
-        _write_kernelspec(kernelspec, spec)
+
+    if disable:
+        _update_kernelspec(kernelspec, edit)
+        script_path.unlink(missing_ok=True)
     else:
-        log.info("No change to %s", kernelspec)
+        # install the script before the kernelspec uses it
+        had_script = script_path.exists()
+        log.info("Installing %s", script_path)
+        _replace_file(script_path, Path(__file__).parent / "_forkserver.py")
+        try:
+            _update_kernelspec(kernelspec, edit)
+        except BaseException:
+            if not had_script:
+                script_path.unlink()
+            raise
+
 
+_IMPORT_TIME_PATTERN = re.compile(
+    r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( +)(\S.*?)\s*$"
+)
+
+# run in the kernel after it's ready to measure memory
+_MEMORY_PROBE = """
+def _a2km_memory_probe(top):
+    import json, resource, sys, tracemalloc
+    info = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in {"VmRSS", "VmHWM"}:
+                    info[key] = int(value.split()[0]) * 1024
+        info["rss"] = info.pop("VmRSS")
+        info["peak_rss"] = info.pop("VmHWM")
+    except (OSError, KeyError, ValueError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        info["peak_rss"] = maxrss if sys.platform == "darwin" else maxrss * 1024
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        info["traced"] = current
+        info["traced_peak"] = peak
+        stats = tracemalloc.take_snapshot().statistics("filename")
+        info["top_allocations"] = [
+            {"file": stat.traceback[0].filename, "size": stat.size, "count": stat.count}
+            for stat in stats[:top]
+        ]
+    return json.dumps(info)
+"""
+
+
+def _parse_import_times(stderr: str) -> list[dict[str, Any]]:
+    """Parse the output of `python -X importtime`"""
+    imports = []
+    for line in stderr.splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append(
+                {
+                    "module": module,
+                    "self_us": int(self_us),
+                    "cumulative_us": int(cumulative_us),
+                    "depth": (len(indent) - 1) // 2,
+                }
+            )
+    return imports
+
+
+def _format_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GiB"
+
+
+def _print_profile(report: dict[str, Any], top: int) -> None:
+    print(f"Kernel: {report['kernelspec']}")
+    print(f"  ready after: {report['startup_seconds']:.2f}s")
+    imports = report["imports"]
+    if imports:
+        total_us = sum(imp["self_us"] for imp in imports)
+        print(f"  imports: {len(imports)} modules in {total_us / 1e6:.2f}s")
+        print(f"\nSlowest imports (self time), top {top}:")
+        for imp in sorted(imports, key=lambda imp: imp["self_us"], reverse=True)[:top]:
+            print(f"  {imp['self_us'] / 1e3:9.1f} ms  {imp['module']}")
+        print(f"\nSlowest top-level imports (cumulative time), top {top}:")
+        top_level = [imp for imp in imports if imp["depth"] == 0]
+        top_level.sort(key=lambda imp: imp["cumulative_us"], reverse=True)
+        for imp in top_level[:top]:
+            print(f"  {imp['cumulative_us'] / 1e3:9.1f} ms  {imp['module']}")
+    else:
+        print("  no import times collected (not a Python kernel?)")
+    memory = report["memory"]
+    if memory:
+        print("\nIdle memory:")
+        for key in ("rss", "peak_rss", "traced", "traced_peak"):
+            if key in memory:
+                print(f"  {key}: {_format_bytes(memory[key])}")
+        if memory.get("top_allocations"):
+            print("\nLargest allocations by file:")
+            for alloc in memory["top_allocations"]:
+                print(f"  {_format_bytes(alloc['size']):>12}  {alloc['file']}")
+
+
+def profile(
+    kernelspec: _PathLike,
+    timeout: float = 60,
+    output: _PathLike | None = None,
+    top: int = 20,
+    tracemalloc: bool = False,
+) -> dict[str, Any]:
+    """Profile a kernel's startup imports and idle memory
+
+    Starts the kernel with import time profiling enabled
+    (and tracemalloc, if requested) via its environment,
+    without modifying the kernelspec.
+    For kernels in envs, profiling is enabled after activation,
+    so the activation command (e.g. conda run) isn't profiled,
+    and prewarmed kernels are started without their forkserver.
+    Once the kernel is ready, its memory use is measured,
+    and the kernel is shut down.
+
+    tracemalloc makes imports slower, which skews import times.
+
+    Prints a report, and writes it to `output` as JSON, if given.
+    Returns the report.
+    """
+    try:
+        from jupyter_client.kernelspec import KernelSpecManager
+        from jupyter_client.manager import KernelManager
+    except ImportError as e:
+        raise ImportError(
+            f"a2km profile requires jupyter_client (pip install 'a2km[profile]'): {e}"
+        ) from None
+
+    kernelspec = locate(kernelspec).absolute()
+    spec = _read_kernelspec(kernelspec)
+    profile_env = {"PYTHONPROFILEIMPORTTIME": "1"}
+    if tracemalloc:
+        profile_env["PYTHONTRACEMALLOC"] = "1"
+
+    argv = _strip_forkserver(spec["argv"])
+    if argv != spec["argv"]:
+        # a forkserver's imports are logged by the server, not the kernel
+        log.info("Profiling %s without its forkserver", kernelspec)
+    limits, argv = _split_limits(spec, argv)
+    kind, preamble = _split_preamble(argv)
+    env = os.environ.copy()
+    if kind:
+        # set the variables after activation,
+        # so e.g. conda's own imports aren't profiled
+        argv = (
+            limits
+            + preamble
+            + ["env"]
+            + [f"{key}={value}" for key, value in profile_env.items()]
+            + argv[len(preamble) :]
+        )
+    else:
+        argv = limits + argv
+        env.update(profile_env)
+    spec["argv"] = [arg.replace("{resource_dir}", str(kernelspec)) for arg in argv]
+
+    memory: dict[str, Any] = {}
+    with TemporaryDirectory() as td:
+        # launch from a modified copy of kernel.json
+        kernels_dir = Path(td) / "kernels"
+        (kernels_dir / kernelspec.name).mkdir(parents=True)
+        (kernels_dir / kernelspec.name / "kernel.json").write_text(
+            _serialize.dumps(spec)
+        )
+        km = KernelManager(
+            kernel_name=kernelspec.name,
+            kernel_spec_manager=KernelSpecManager(kernel_dirs=[str(kernels_dir)]),
+        )
+        stderr_path = Path(td) / "stderr"
+        with stderr_path.open("wb") as stderr:
+            log.info("Starting %s", kernelspec)
+            start = time.perf_counter()
+            km.start_kernel(env=env, stderr=stderr)
+            kc = km.blocking_client()
+            try:
+                kc.start_channels()
+                kc.wait_for_ready(timeout=timeout)
+                startup_seconds = time.perf_counter() - start
+                log.info("Kernel ready after %.2fs", startup_seconds)
+                reply = kc.execute_interactive(
+                    _MEMORY_PROBE,
+                    silent=True,
+                    store_history=False,
+                    user_expressions={"memory": f"_a2km_memory_probe({top})"},
+                    timeout=timeout,
+                    output_hook=lambda msg: None,
+                )
+                result = reply["content"].get("user_expressions", {}).get("memory", {})
+                if result.get("status") == "ok":
+                    memory = _serialize.loads(
+                        ast.literal_eval(result["data"]["text/plain"])
+                    )
+                else:
+                    log.warning("Could not measure kernel memory: %s", result)
+            finally:
+                kc.stop_channels()
+                km.shutdown_kernel(now=True)
+        stderr_text = stderr_path.read_text(errors="replace")
 
-def remove(kernelspec: _PathLike, force: bool = False) -> None:
-    """Remove a kernelspec"""
+    report = {
+        "kernelspec": str(kernelspec),
+        "startup_seconds": startup_seconds,
+        "imports": _parse_import_times(stderr_text),
+        "memory": memory,
+    }
+    _print_profile(report, top)
+    if output:
+        log.info("Writing profile to %s", output)
+        with Path(output).open("w") as f:
+            f.write(_serialize.dumps(report))
+    return report
+
+
+_TRASH_DIR = ".a2km-trash"
+
+
+def _purge_in_background(kernels_dir: Path) -> None:
+    """Start a process to purge the trash in a kernels directory"""
+    cmd = [sys.executable, "-m", "a2km", "purge", str(kernels_dir)]
+    log.debug("Calling %s in the background", shlex.join(cmd))
+    Popen(
+        cmd,
+        stdin=DEVNULL,
+        stdout=DEVNULL,
+        stderr=DEVNULL,
+        start_new_session=True,
+    )
+
+
+def remove(kernelspec: _PathLike, force: bool = False, purge: bool = False) -> None:
+    """Remove a kernelspec
+
+    The kernelspec is moved to a trash directory next to it,
+    so it disappears immediately.
+    If purge is True, the trash is deleted in a background process,
+    otherwise it's left for `a2km purge`.
+    """
     kernelspec = locate(kernelspec)
     if not force:
         ans = input(f"Remove {kernelspec} [y/N]? ")
@@ -229,7 +1241,259 @@ def remove(kernelspec: _PathLike, force: bool = False) -> None:
             print("Operation cancelled", file=sys.stderr)
             return
     log.info(f"Removing {kernelspec}")
-    shutil.rmtree(kernelspec)
+    trashed = f"{kernelspec.name}.{secrets.token_urlsafe(6)}"
+    with _trash_dir(kernelspec.parent) as trash_fd:
+        if trash_fd is None:
+            kernelspec.rename(kernelspec.parent / _TRASH_DIR / trashed)
+        else:
+            # relative to the directory we checked, even if it's replaced since
+            os.rename(kernelspec, trashed, dst_dir_fd=trash_fd)
+    if purge:
+        _purge_in_background(kernelspec.parent)
+
+
+@contextmanager
+def _trash_dir(kernels_dir: Path) -> Generator[int | None]:
+    """Open the trash directory in a kernels directory, creating it if needed
+
+    Yields a file descriptor for the trash directory
+    (None on Windows, where removed kernelspecs are moved by path).
+    The trash directory gets the same owner and permissions as the kernels directory,
+    so removing another user's kernelspec (e.g. as root)
+    doesn't leave them a trash directory they can't use.
+    A symlink in place of the trash directory is refused,
+    so users can't make root move or chown files elsewhere.
+    """
+    trash_dir = kernels_dir / _TRASH_DIR
+    trash_dir.mkdir(exist_ok=True)
+    if not hasattr(os, "O_NOFOLLOW"):
+        # Windows
+        yield None
+        return
+    try:
+        fd = os.open(trash_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError as e:
+        if e.errno in {errno.ELOOP, errno.ENOTDIR}:
+            raise NotADirectoryError(
+                errno.ENOTDIR, "Trash is a symlink or not a directory", str(trash_dir)
+            ) from None
+        raise
+    try:
+        st = kernels_dir.stat()
+        trash_st = os.fstat(fd)
+        if stat.S_IMODE(trash_st.st_mode) != stat.S_IMODE(st.st_mode):
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        if (trash_st.st_uid, trash_st.st_gid) != (st.st_uid, st.st_gid):
+            try:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            except PermissionError as e:
+                log.warning("Could not set owner of %s: %s", trash_dir, e)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+_CLAIM = ".purging-"
+
+
+def _claim_is_stale(claim: str) -> bool:
+    """Whether a claimed trash entry's purge process is gone
+
+    Only claims made on this host can be checked.
+    """
+    host, _, pid = claim.rpartition("-")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # exists, owned by someone else
+        return False
+    return False
+
+
+def _purge_one(trashed: Path) -> None:
+    # claim it first, so concurrent purges don't delete the same files
+    name = trashed.name.partition(_CLAIM)[0]
+    claimed = trashed.with_name(f"{name}{_CLAIM}{socket.gethostname()}-{os.getpid()}")
+    try:
+        trashed.rename(claimed)
+    except FileNotFoundError:
+        # claimed by another purge
+        return
+    log.debug("Deleting %s", claimed)
+    try:
+        if claimed.is_symlink() or not claimed.is_dir():
+            claimed.unlink()
+        else:
+            shutil.rmtree(claimed)
+    except OSError:
+        # release the claim, so the next purge retries
+        claimed.rename(trashed)
+        raise
+
+
+def purge(
+    kernels_dirs: list[_PathLike] | None = None, max_workers: int | None = None
+) -> dict[Path, BaseException | None]:
+    """Delete removed kernelspecs
+
+    Deletes kernelspecs that `rm` moved to the trash,
+    in parallel.
+    Entries left behind by interrupted purges on this host are deleted too.
+    Trash directories that are symlinks,
+    or aren't owned by the owner of their kernels directory, are skipped.
+    By default, all kernels directories on the search path are purged.
+    Returns a dict of each entry in the trash to the exception raised deleting it, if any.
+    Failures are logged, and don't stop the other entries from being deleted.
+    """
+    dirs = kernels_dirs or _kernels_dirs()
+    trashed: list[Path] = []
+    for kernels_dir in dirs:
+        trash_dir = Path(kernels_dir) / _TRASH_DIR
+        try:
+            trash_st = trash_dir.lstat()
+            kernels_dir_st = Path(kernels_dir).stat()
+        except FileNotFoundError:
+            continue
+        if (
+            not stat.S_ISDIR(trash_st.st_mode)
+            or trash_st.st_uid != kernels_dir_st.st_uid
+        ):
+            # don't follow a symlink (e.g. made by another user) out of the trash
+            log.warning(
+                "Skipping %s: a symlink, not a directory, or not owned by the owner of %s",
+                trash_dir,
+                kernels_dir,
+            )
+            continue
+        try:
+            entries = list(trash_dir.iterdir())
+        except FileNotFoundError:
+            continue
+        for path in entries:
+            claim = path.name.partition(_CLAIM)[2]
+            if not claim or _claim_is_stale(claim):
+                trashed.append(path)
+    if not trashed:
+        log.debug("Nothing to purge")
+        return {}
+    log.info("Purging %i removed kernelspecs", len(trashed))
+    results = map_kernelspecs(_purge_one, trashed, max_workers=max_workers)
+    for path, error in results.items():
+        if error is not None:
+            log.warning("Failed to delete %s: %s", path, error)
+    return results
+
+
+def _resource_files(kernels_dir: Path) -> Generator[tuple[Path, os.stat_result]]:
+    """Regular files in kernelspecs other than kernel.json itself"""
+    try:
+        kernel_dirs = [
+            path
+            for path in kernels_dir.iterdir()
+            if not path.name.startswith(".") and path.is_dir()
+        ]
+    except FileNotFoundError:
+        return
+    for kernel_dir in kernel_dirs:
+        for dirpath, dirnames, filenames in os.walk(kernel_dir):
+            for filename in filenames:
+                path = Path(dirpath, filename)
+                if path == kernel_dir / "kernel.json":
+                    continue
+                st = path.lstat()
+                # empty files have no blocks to reclaim
+                if stat.S_ISREG(st.st_mode) and st.st_size:
+                    yield path, st
+
+
+def _file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dedupe(
+    kernels_dirs: list[_PathLike] | None = None,
+    dry_run: bool = False,
+    max_workers: int | None = None,
+) -> tuple[int, int, int]:
+    """Hardlink identical resource files (logos, etc.) across kernelspecs
+
+    Files are only linked if they have the same contents, owner and permissions,
+    and are on the same filesystem.
+    kernel.json is never linked, because it is edited per kernelspec.
+    By default, all kernels directories on the search path are deduplicated.
+    Files that can't be linked (e.g. in directories that aren't writable)
+    are logged and skipped.
+    Returns the number of bytes and inodes reclaimed (or that would be, with dry_run),
+    and the number of files skipped.
+    """
+    dirs = kernels_dirs or _kernels_dirs()
+    # group by everything that's cheap to compare, before hashing
+    candidates: dict[tuple, list[tuple[Path, os.stat_result]]] = {}
+    for kernels_dir in dirs:
+        for path, st in _resource_files(Path(kernels_dir)):
+            key = (st.st_dev, st.st_size, st.st_uid, st.st_gid, st.st_mode)
+            candidates.setdefault(key, []).append((path, st))
+    to_hash = [
+        (key, path, st)
+        for key, files in candidates.items()
+        # already one inode, nothing to do
+        if len({st.st_ino for path, st in files}) > 1
+        for path, st in files
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        hashes = pool.map(_file_hash, (path for key, path, st in to_hash))
+        groups: dict[tuple, list[tuple[Path, os.stat_result]]] = {}
+        for (key, path, st), digest in zip(to_hash, hashes):
+            groups.setdefault(key + (digest,), []).append((path, st))
+
+    # links to each inode that have been replaced
+    replaced: dict[tuple[int, int], int] = {}
+    reclaimed_bytes = reclaimed_inodes = skipped = 0
+    for files in groups.values():
+        # keep the inode with the most links, so repeated runs converge
+        canonical, canonical_st = max(files, key=lambda file: file[1].st_nlink)
+        for path, st in files:
+            if st.st_ino == canonical_st.st_ino:
+                continue
+            if dry_run:
+                if not os.access(path.parent, os.W_OK):
+                    log.warning("Skipping %s, directory not writable", path)
+                    skipped += 1
+                    continue
+            else:
+                if _stamp(path.lstat()) != _stamp(st):
+                    log.warning("Skipping %s, modified while deduplicating", path)
+                    skipped += 1
+                    continue
+                tmp_path = path.with_name(f".{path.name}.a2km-{secrets.token_hex(4)}")
+                try:
+                    os.link(canonical, tmp_path)
+                    try:
+                        os.replace(tmp_path, path)
+                    except BaseException:
+                        tmp_path.unlink()
+                        raise
+                except OSError as e:
+                    # e.g. read-only prefix, too many links, or no hardlinks at all
+                    log.warning("Skipping %s, could not link: %s", path, e)
+                    skipped += 1
+                    continue
+            log.debug("Linked %s -> %s", path, canonical)
+            inode = (st.st_dev, st.st_ino)
+            replaced[inode] = replaced.get(inode, 0) + 1
+            if replaced[inode] == st.st_nlink:
+                # that was the last link, the file is gone
+                reclaimed_bytes += st.st_size
+                reclaimed_inodes += 1
+    return reclaimed_bytes, reclaimed_inodes, skipped
 
 
 def clone(kernelspec: _PathLike, to: _PathLike) -> Path:
@@ -244,26 +1508,90 @@ def clone(kernelspec: _PathLike, to: _PathLike) -> Path:
         # if it's a path, use it as one
         to = to.absolute()
     shutil.copytree(kernelspec, to)
+    _relocate_env(to, kernelspec)
     return to
 
 
-def env_kernel(
-    env: _PathLike,
-    kind: str,
-    kernel_name: str = "",
-    install_data_dir: str | Path = "",
-    install_prefix: str | Path = "",
-):
-    """Register a kernel for a conda environment or virtualenv
+def _source_date_epoch() -> int:
+    """The timestamp for reproducible output
 
-    install_data_dir is the entry on JUPYTER_PATH,
-    whereas install_prefix is the typical install prefix.
-    install_prefix="$prefix" is equivalent to
-    install_data_dir="$prefix/share/jupyter"
+    from $SOURCE_DATE_EPOCH, if set (https://reproducible-builds.org/specs/source-date-epoch/)
     """
+    return int(os.environ.get("SOURCE_DATE_EPOCH") or 0)
 
-    env = Path(env)
 
+def freeze(kernelspec: _PathLike, mtime: int | None = None) -> None:
+    """Make a kernelspec directory byte-for-byte reproducible
+
+    For stable container image layers and other content-addressed storage:
+
+    - kernel.json keys are sorted
+    - the kernelspec's own path in argv is replaced with {resource_dir}
+    - leftover a2km temporary files are removed
+    - permissions are normalized to 644 (755 for executables and directories)
+      (hardlinked files are copied first, so other kernelspecs sharing them don't change)
+    - all mtimes are set to `mtime` (default: $SOURCE_DATE_EPOCH, or 0)
+    """
+    kernelspec = locate(kernelspec).absolute()
+    if mtime is None:
+        mtime = _source_date_epoch()
+    mtime_ns = mtime * 1_000_000_000
+
+    spec = _read_kernelspec(kernelspec)
+    resource_dir = str(kernelspec)
+    if "argv" in spec:
+        spec["argv"] = [
+            _replace_path_prefix(arg, resource_dir, "{resource_dir}")
+            for arg in spec["argv"]
+        ]
+    _write_kernelspec(kernelspec, _serialize.dumps(spec, sort_keys=True))
+
+    log.info("Normalizing permissions and mtimes in %s", kernelspec)
+    # bottom-up, so setting mtimes of children doesn't change their parents
+    for dirpath, dirnames, filenames in os.walk(kernelspec, topdown=False):
+        for name in filenames:
+            path = Path(dirpath) / name
+            if ".a2km." in name:
+                log.debug("Removing temporary file %s", path)
+                path.unlink()
+                continue
+            if path.is_symlink():
+                os.utime(path, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+                continue
+            if path.stat().st_nlink > 1:
+                # shared with other kernelspecs by dedupe, don't change them too
+                log.debug("Unlinking %s", path)
+                _replace_file(path, path)
+            mode = path.stat().st_mode
+            path.chmod(0o755 if mode & 0o111 else 0o644)
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        for name in dirnames:
+            path = Path(dirpath) / name
+            if path.is_symlink():
+                os.utime(path, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+            else:
+                path.chmod(0o755)
+                os.utime(path, ns=(mtime_ns, mtime_ns))
+    kernelspec.chmod(0o755)
+    os.utime(kernelspec, ns=(mtime_ns, mtime_ns))
+
+
+def _cache_dir() -> Path:
+    """The per-user cache directory for a2km"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "a2km"
+
+
+_VENV_PREAMBLE = ("sh", "-c", '. "${ENV_PREFIX}/bin/activate" && exec "$0" "$@"')
+_CONDA_PREAMBLE = ("conda", "run", "--no-capture-output")
+
+
+def _env_commands(env: Path, kind: str) -> tuple[list[str], list[str]]:
+    """Commands for running an env's Python
+
+    Returns the command to run Python in the env from here,
+    and the kernelspec argv preamble to activate the env.
+    """
     if kind == "venv":
         # todo: lookup venv by name
         if not env.exists():
@@ -271,7 +1599,7 @@ def env_kernel(
                 f"venvs must be resolvable paths, did not find env at {env}"
             )
         python_cmd = [str(env / "bin" / "python3")]
-        preamble = ["sh", "-c", '. "${ENV_PREFIX}/bin/activate" && exec "$0" "$@"']
+        preamble = list(_VENV_PREAMBLE)
 
     elif kind == "conda":
         # TODO: support invoking via [micro]mamba
@@ -283,6 +1611,133 @@ def env_kernel(
             python_cmd = ["conda", "run", "-n", str(env), "python3"]
             preamble += ["--name"]
         preamble += [str(env)]
+    else:
+        raise ValueError(f"kind must be 'conda' or 'venv', not {kind!r}")
+    return python_cmd, preamble
+
+
+def _split_preamble(argv: list[str]) -> tuple[str, list[str]]:
+    """Find the env activation preamble generated by env_kernel in an argv
+
+    Returns the env kind ('conda', 'venv', or '' if there's no recognized preamble)
+    and the preamble.
+    """
+    if tuple(argv[:3]) == _VENV_PREAMBLE:
+        return "venv", argv[:3]
+    if tuple(argv[:3]) == _CONDA_PREAMBLE and len(argv) > 4:
+        if argv[3] in {"--prefix", "-p", "--name", "-n"}:
+            return "conda", argv[:5]
+    return "", []
+
+
+def _split_limits(spec: dict, argv: list[str]) -> tuple[list[str], list[str]]:
+    """Split the taskset/prlimit wrapper added by `resources` off an argv"""
+    limits = spec.get("metadata", {}).get("a2km", {}).get("resources", {})
+    limits_argv = limits.get("argv", [])
+    if limits_argv and argv[: len(limits_argv)] == limits_argv:
+        return limits_argv, argv[len(limits_argv) :]
+    return [], argv
+
+
+def _is_writable(path: Path) -> bool:
+    return os.access(path, os.W_OK)
+
+
+def precompile(
+    env: _PathLike,
+    kind: str = "conda",
+    pycache_prefix: _PathLike | None = None,
+    jobs: int = 0,
+) -> Path | None:
+    """Precompile an env's Python bytecode
+
+    Compiles the standard library and site-packages of the env in parallel,
+    so the first kernel start doesn't compile them,
+    which read-only envs would do on every start.
+
+    If the env's site-packages aren't writable, bytecode is written to pycache_prefix instead
+    (default: in the a2km cache directory),
+    which must be used as PYTHONPYCACHEPREFIX when running the env.
+    Otherwise, bytecode is written in place,
+    skipping a read-only standard library (e.g. of the system Python a venv is based on).
+    Returns the pycache prefix if one is used.
+    """
+    env = Path(env)
+    python_cmd, _ = _env_commands(env, kind)
+    get_paths = (
+        "import json, sysconfig;"
+        "print(json.dumps({p: sysconfig.get_path(p) for p in"
+        " ('stdlib', 'platstdlib', 'purelib', 'platlib')}))"
+    )
+    cmd = python_cmd + ["-c", get_paths]
+    log.debug("Calling %s", shlex.join(cmd))
+    out = check_output(cmd, text=True)
+    lib_paths = _serialize.loads(out.strip().splitlines()[-1])
+    env_lib_dirs = {Path(lib_paths["purelib"]), Path(lib_paths["platlib"])}
+    lib_dirs = env_lib_dirs | {
+        Path(lib_paths["stdlib"]),
+        Path(lib_paths["platstdlib"]),
+    }
+    lib_dirs = {p for p in lib_dirs if p.exists()}
+
+    envvars = os.environ.copy()
+    # only the env's own packages decide:
+    # a venv's stdlib is usually a read-only system Python,
+    # whose bytecode is already compiled and would be ignored with a prefix
+    if all(_is_writable(p) for p in env_lib_dirs if p.exists()):
+        pycache_prefix = None
+        # compile what we can write, in place
+        lib_dirs = {p for p in lib_dirs if _is_writable(p)}
+    elif pycache_prefix is None:
+        pycache_prefix = _cache_dir() / "pycache" / f"{env.name}-{_path_hash(env)}"
+    if pycache_prefix is not None:
+        pycache_prefix = Path(pycache_prefix).absolute()
+        pycache_prefix.mkdir(parents=True, exist_ok=True)
+        envvars["PYTHONPYCACHEPREFIX"] = str(pycache_prefix)
+        log.info("Precompiling %s into %s", env, pycache_prefix)
+    else:
+        log.info("Precompiling %s", env)
+
+    cmd = python_cmd + ["-m", "compileall", "-q", "-j", str(jobs)]
+    cmd += [str(p) for p in sorted(lib_dirs)]
+    log.debug("Calling %s", shlex.join(cmd))
+    p = run(cmd, env=envvars, stdout=PIPE, text=True)
+    if p.returncode:
+        # some packages ship files that don't compile (e.g. test data)
+        log.warning("Some files in %s could not be compiled:\n%s", env, p.stdout)
+    return pycache_prefix
+
+
+def _path_hash(path: Path) -> str:
+    return hashlib.sha256(str(path.absolute()).encode("utf8")).hexdigest()[:8]
+
+
+def env_kernel(
+    env: _PathLike,
+    kind: str,
+    kernel_name: str = "",
+    install_data_dir: str | Path = "",
+    install_prefix: str | Path = "",
+    compile_bytecode: bool = False,
+    freeze_output: bool = False,
+):
+    """Register a kernel for a conda environment or virtualenv
+
+    install_data_dir is the entry on JUPYTER_PATH,
+    whereas install_prefix is the typical install prefix.
+    install_prefix="$prefix" is equivalent to
+    install_data_dir="$prefix/share/jupyter"
+
+    If compile_bytecode is True, the env's bytecode is precompiled.
+    If the env isn't writable, bytecode is stored in the kernelspec directory,
+    and the kernelspec sets PYTHONPYCACHEPREFIX to use it.
+
+    If freeze_output is True, the kernelspec directory is made reproducible
+    with `freeze`.
+    """
+
+    env = Path(env)
+    python_cmd, preamble = _env_commands(env, kind)
 
     if install_data_dir and install_prefix:
         raise ValueError(
@@ -346,5 +1801,110 @@ def env_kernel(
     spec["argv"][0] = Path(spec["argv"][0]).name
     # activate env with preamble
     spec["argv"] = preamble + spec["argv"]
+    if compile_bytecode:
+        pycache_prefix = precompile(env, kind, pycache_prefix=kernel_dest / "pycache")
+        if pycache_prefix is not None:
+            spec.setdefault("env", {})["PYTHONPYCACHEPREFIX"] = str(pycache_prefix)
     _write_kernelspec(kernel_dest, spec)
+    if freeze_output:
+        freeze(kernel_dest)
     return kernel_dest
+
+
+# variables that differ between calls from the same shell,
+# but don't affect env activation
+_VOLATILE_ENV = {"PWD", "OLDPWD", "SHLVL", "_"}
+
+# files that change when an env is modified
+_ENV_STAMP_FILES = {
+    "conda": Path("conda-meta", "history"),
+    "venv": Path("bin", "activate"),
+}
+
+_PRINT_ENV = "import json, os, sys; json.dump(dict(os.environ), sys.stdout)"
+
+
+def _env_stamp(kind: str, prefix: str) -> tuple[int, int, int] | None:
+    try:
+        return _stamp(os.stat(Path(prefix) / _ENV_STAMP_FILES[kind]))
+    except (FileNotFoundError, KeyError):
+        return None
+
+
+def resolve_env(kernelspec: _PathLike) -> dict[str, str]:
+    """Resolve the environment a kernel runs in
+
+    Applies the kernelspec's env to the current environment,
+    and, if the kernelspec activates an env with a preamble generated by env_kernel,
+    the changes made by activating it.
+    Activation is cached in the a2km cache directory,
+    keyed by the preamble and environment,
+    until the env is modified (e.g. packages are installed),
+    so repeated calls don't start conda.
+    """
+    kernelspec = locate(kernelspec)
+    spec = _read_kernelspec(kernelspec)
+    environ = os.environ.copy()
+    environ.update(spec.get("env", {}))
+    # skip taskset/prlimit added by `resources`
+    _, argv = _split_limits(spec, _strip_forkserver(spec.get("argv", [])))
+    kind, preamble = _split_preamble(argv)
+    if not kind:
+        return environ
+
+    key_env = {key: value for key, value in environ.items() if key not in _VOLATILE_ENV}
+    key = hashlib.sha256(
+        _serialize.dumps([preamble, key_env], sort_keys=True).encode("utf8")
+    ).hexdigest()
+    cache_file = _cache_dir() / "exec" / f"{key[:32]}.json"
+    try:
+        with cache_file.open("rb") as f:
+            cached = _serialize.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        cached = None
+    if cached is not None and cached["stamp"] == list(
+        _env_stamp(kind, cached["prefix"]) or []
+    ):
+        log.debug("Using cached environment for %s from %s", kernelspec, cache_file)
+    else:
+        cmd = preamble + [sys.executable, "-c", _PRINT_ENV]
+        log.debug("Resolving environment for %s with %s", kernelspec, shlex.join(cmd))
+        activated = _serialize.loads(check_output(cmd, env=environ))
+        if kind == "venv":
+            prefix = environ["ENV_PREFIX"]
+        else:
+            prefix = activated.get("CONDA_PREFIX", "")
+        cached = {
+            "prefix": prefix,
+            "stamp": list(_env_stamp(kind, prefix) or []),
+            "set": {
+                key: value
+                for key, value in activated.items()
+                if environ.get(key) != value and key not in _VOLATILE_ENV
+            },
+            "unset": sorted(
+                key
+                for key in environ
+                if key not in activated and key not in _VOLATILE_ENV
+            ),
+        }
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with _atomic_write(cache_file) as f:
+            f.write(_serialize.dumps(cached))
+    for key in cached["unset"]:
+        environ.pop(key, None)
+    environ.update(cached["set"])
+    return environ
+
+
+def exec_command(kernelspec: _PathLike, cmd: list[str] | None = None) -> None:
+    """Run a command in a kernel's environment
+
+    The command replaces this process.
+    The default command is $SHELL.
+    """
+    environ = resolve_env(kernelspec)
+    if not cmd:
+        cmd = [os.environ.get("SHELL") or "sh"]
+    log.debug("Running %s", shlex.join(cmd))
+    os.execvpe(cmd[0], cmd, environ)
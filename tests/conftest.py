@@ -59,7 +59,7 @@ def kernelspec(jupyter_dir: Path, jupyter_env):
 
 
 @pytest.fixture(autouse=True)
-def jupyter_env(jupyter_dir: Path, jupyter_dir_2):
+def jupyter_env(jupyter_dir: Path, jupyter_dir_2, tmp_path: Path):
     # make sure we don't inherit the user env
     with (
         mock.patch.dict(
@@ -67,6 +67,7 @@ def jupyter_env(jupyter_dir: Path, jupyter_dir_2):
             {
                 "JUPYTER_PATH": f"{jupyter_dir}{os.pathsep}{jupyter_dir_2}",
                 "JUPYTER_PLATFORM_DIRS": "1",
+                "XDG_CACHE_HOME": str(tmp_path / "cache"),
             },
         ),
         mock.patch("site.ENABLE_USER_SITE", False),
@@ -1,4 +1,6 @@
+import json
 import os
+import stat
 import sys
 from contextlib import nullcontext
 from subprocess import check_output
@@ -7,6 +9,7 @@ from unittest import mock
 import pytest
 
 from a2km._cli import main
+from tests.conftest import make_kernelspec
 
 
 def run(*cmd, **kwargs):
@@ -121,7 +124,14 @@ def test_rm_env(args, called_with):
 @pytest.mark.parametrize(
     "args, called_with",
     [
-        pytest.param(["spec", "arg1", "arg2"], ("spec", ["arg1", "arg2"]), id="basic"),
+        pytest.param(
+            ["spec", "arg1", "arg2"], ("spec", ["arg1", "arg2"], False), id="basic"
+        ),
+        pytest.param(
+            ["spec", "--prepend", "--", "taskset", "-c", "0"],
+            ("spec", ["taskset", "-c", "0"], True),
+            id="--prepend",
+        ),
         pytest.param(["spec"], SystemExit, id="no args"),
     ],
 )
@@ -143,8 +153,9 @@ def test_rm_argv(args, called_with):
 @pytest.mark.parametrize(
     "args, called_with",
     [
-        pytest.param(["spec"], ("spec", False), id="default"),
-        pytest.param(["spec", "--force"], ("spec", True), id="--force"),
+        pytest.param(["spec"], ("spec", False, True), id="default"),
+        pytest.param(["spec", "--force"], ("spec", True, True), id="--force"),
+        pytest.param(["spec", "--no-purge"], ("spec", False, False), id="--no-purge"),
         pytest.param([], SystemExit, id="no args"),
     ],
 )
@@ -163,6 +174,8 @@ def test_rm(args, called_with):
                     "kind": "conda",
                     "kernel_name": "",
                     "install_prefix": "sys-prefix",
+                    "compile_bytecode": False,
+                    "freeze_output": False,
                 },
             ),
             id="default",
@@ -175,12 +188,293 @@ def test_rm(args, called_with):
                     "kind": "conda",
                     "kernel_name": "mykernel",
                     "install_prefix": "user",
+                    "compile_bytecode": False,
+                    "freeze_output": False,
                 },
             ),
             id="default",
         ),
+        pytest.param(
+            ["env", "--kind=venv", "--precompile"],
+            (
+                ("env",),
+                {
+                    "kind": "venv",
+                    "kernel_name": "",
+                    "install_prefix": "sys-prefix",
+                    "compile_bytecode": True,
+                    "freeze_output": False,
+                },
+            ),
+            id="--precompile",
+        ),
+        pytest.param(
+            ["env", "--freeze"],
+            (
+                ("env",),
+                {
+                    "kind": "conda",
+                    "kernel_name": "",
+                    "install_prefix": "sys-prefix",
+                    "compile_bytecode": False,
+                    "freeze_output": True,
+                },
+            ),
+            id="--freeze",
+        ),
         pytest.param([], SystemExit, id="no args"),
     ],
 )
 def test_env_kernel(args, called_with):
     cli_test(["env-kernel"] + args, "env_kernel", called_with)
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param(["spec"], (("spec", []), {}), id="default"),
+        pytest.param(
+            ["spec", "--", "python", "-c", "pass"],
+            (("spec", ["python", "-c", "pass"]), {}),
+            id="cmd",
+        ),
+    ],
+)
+def test_exec(args, called_with):
+    cli_test(["exec"] + args, "exec_command", called_with)
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param(
+            ["spec", "--threads=4"], ("spec", 4, None, None, False), id="threads"
+        ),
+        pytest.param(
+            ["spec", "--cpus=0-3", "--memory=8G"],
+            ("spec", None, "0-3", "8G", False),
+            id="cpus-memory",
+        ),
+        pytest.param(["spec", "--clear"], ("spec", None, None, None, True), id="clear"),
+        pytest.param(["spec"], SystemExit, id="nothing"),
+    ],
+)
+def test_resources(args, called_with):
+    cli_test(["resources"] + args, "resources", called_with)
+
+
+def test_build_catalog():
+    cli_test(["build-catalog", "kernels"], "build_catalog", ["kernels"])
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param(
+            ["spec"],
+            (("spec", []), {"idle_timeout": 600, "disable": False}),
+            id="default",
+        ),
+        pytest.param(
+            ["spec", "numpy", "pandas", "--idle-timeout=60"],
+            (("spec", ["numpy", "pandas"]), {"idle_timeout": 60, "disable": False}),
+            id="preload",
+        ),
+        pytest.param(
+            ["spec", "--disable"],
+            (("spec", []), {"idle_timeout": 600, "disable": True}),
+            id="--disable",
+        ),
+    ],
+)
+def test_prewarm(args, called_with):
+    cli_test(["prewarm"] + args, "prewarm", called_with)
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param(
+            ["env"],
+            (("env",), {"kind": "conda", "pycache_prefix": None, "jobs": 0}),
+            id="default",
+        ),
+        pytest.param(
+            ["env", "--kind=venv", "--pycache-prefix=/tmp/x", "-j", "4"],
+            (("env",), {"kind": "venv", "pycache_prefix": "/tmp/x", "jobs": 4}),
+            id="options",
+        ),
+    ],
+)
+def test_precompile(args, called_with):
+    cli_test(["precompile"] + args, "precompile", called_with)
+
+
+def test_selection(jupyter_dir, jupyter_dir_2, capsys):
+    mocked = cli_test(["add-env", "test-*", "key=value"], "add_env")
+    assert sorted(call.args[0] for call in mocked.call_args_list) == [
+        jupyter_dir / "kernels" / "test-1",
+        jupyter_dir_2 / "kernels" / "test-2",
+    ]
+    assert all(call.args[1] == {"key": "value"} for call in mocked.call_args_list)
+    captured = capsys.readouterr()
+    assert f"{jupyter_dir / 'kernels' / 'test-1'}: ok" in captured.out
+
+    mocked = cli_test(["set", "*", "--where", "env=in", "key", "value"], "set")
+    mocked.assert_called_once_with(
+        jupyter_dir / "kernels" / "in-both", {"key": "value"}
+    )
+
+    cli_test(["rm-env", "nosuch-*", "key"], "remove_env", SystemExit)
+
+
+def test_selection_rm(jupyter_dir, jupyter_dir_2):
+    with (
+        mock.patch("builtins.input", return_value="y") as mock_input,
+        mock.patch("a2km.operations._purge_in_background") as mock_purge,
+    ):
+        mocked = cli_test(["rm", "test-*"], "remove")
+    assert mock_input.call_count == 1
+    assert mocked.call_count == 2
+    assert all(call.args[1:] == (True, False) for call in mocked.call_args_list)
+    # purged once per kernels directory
+    assert sorted(call.args[0] for call in mock_purge.call_args_list) == [
+        jupyter_dir / "kernels",
+        jupyter_dir_2 / "kernels",
+    ]
+
+    with mock.patch("builtins.input", return_value="n"):
+        mocked = cli_test(["rm", "test-*"], "remove")
+    assert mocked.call_count == 0
+
+
+def test_selection_users(tmp_path, capsys):
+    users = tmp_path / "home"
+    for user in ("alice", "bob"):
+        kernels_dir = users / user / ".local" / "share" / "jupyter" / "kernels"
+        make_kernelspec("python3", kernels_dir)
+        make_kernelspec("other", kernels_dir)
+    main(["add-env", "python3", "--users-root", str(users), "key=value"])
+    captured = capsys.readouterr()
+    assert "alice: 1 ok, 0 failed" in captured.out
+    assert "bob: 1 ok, 0 failed" in captured.out
+    for user in ("alice", "bob"):
+        kernel_json = users / user / ".local/share/jupyter/kernels/python3/kernel.json"
+        assert json.loads(kernel_json.read_text())["env"] == {"key": "value"}
+
+    data_dir = tmp_path / "jupyter"
+    mocked = cli_test(["set", "*", "--data-dir", str(data_dir), "k", "v"], "set")
+    assert sorted(call.args[0] for call in mocked.call_args_list) == [
+        data_dir / "kernels" / "in-both",
+        data_dir / "kernels" / "test-1",
+    ]
+
+
+def test_selection_users_symlinks(tmp_path, capsys):
+    users = tmp_path / "home"
+    outside = tmp_path / "outside"
+    make_kernelspec("python3", outside)
+    # a user's kernels directory pointing out of their home
+    (users / "alice" / ".local" / "share" / "jupyter").mkdir(parents=True)
+    (users / "alice" / ".local" / "share" / "jupyter" / "kernels").symlink_to(outside)
+    # a user's kernelspec pointing out of their kernels directory
+    bob_kernels = users / "bob" / ".local" / "share" / "jupyter" / "kernels"
+    bob_kernels.mkdir(parents=True)
+    (bob_kernels / "python3").symlink_to(outside / "python3")
+    with pytest.raises(SystemExit):
+        main(["add-env", "python3", "--users-root", str(users), "key=value"])
+    kernel_json = outside / "python3" / "kernel.json"
+    assert "env" not in json.loads(kernel_json.read_text())
+
+
+def test_selection_users_trash_symlink(tmp_path, capsys):
+    users = tmp_path / "home"
+    outside = tmp_path / "outside"
+    outside.mkdir(mode=0o755)
+    (outside / "file").write_text("x")
+    kernels_dir = users / "alice" / ".local" / "share" / "jupyter" / "kernels"
+    make_kernelspec("python3", kernels_dir)
+    kernels_dir.chmod(0o777)
+    (kernels_dir / ".a2km-trash").symlink_to(outside)
+    with pytest.raises(SystemExit):
+        main(["rm", "python3", "--users-root", str(users), "--force", "--no-purge"])
+    # the kernelspec stays, and the symlink's target isn't changed
+    assert (kernels_dir / "python3" / "kernel.json").exists()
+    assert sorted(p.name for p in outside.iterdir()) == ["file"]
+    assert stat.S_IMODE(outside.stat().st_mode) == 0o755
+
+    # or deleted by purge
+    main(["purge", "--users-root", str(users)])
+    assert (outside / "file").exists()
+    assert "Purged 0 removed kernelspecs" in capsys.readouterr().out
+
+
+def test_selection_failed(jupyter_dir, capsys):
+    with pytest.raises(SystemExit):
+        main(["add-argv", "test-*", "--where=argv0=nosuch", "x"])
+    no_argv = jupyter_dir / "kernels" / "test-no-argv"
+    no_argv.mkdir()
+    (no_argv / "kernel.json").write_text("{}")
+    with pytest.raises(SystemExit):
+        main(["add-argv", "test-*", "--", "--debug"])
+    captured = capsys.readouterr()
+    assert f"{no_argv}: failed" in captured.out
+    assert f"{jupyter_dir / 'kernels' / 'test-1'}: ok" in captured.out
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param(
+            ["spec"],
+            (
+                ("spec",),
+                {"timeout": 60, "output": None, "top": 20, "tracemalloc": False},
+            ),
+            id="default",
+        ),
+        pytest.param(
+            ["spec", "-o", "out.json", "--top=5", "--tracemalloc"],
+            (
+                ("spec",),
+                {"timeout": 60, "output": "out.json", "top": 5, "tracemalloc": True},
+            ),
+            id="options",
+        ),
+    ],
+)
+def test_profile(args, called_with):
+    cli_test(["profile"] + args, "profile", called_with)
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param([], (([],), {"max_workers": None}), id="default"),
+        pytest.param(
+            ["a", "b", "-j", "2"], ((["a", "b"],), {"max_workers": 2}), id="dirs"
+        ),
+    ],
+)
+def test_purge(args, called_with):
+    cli_test(["purge"] + args, "purge", called_with)
+
+
+@pytest.mark.parametrize(
+    "args, called_with",
+    [
+        pytest.param(["spec"], (("spec",), {"mtime": None}), id="default"),
+        pytest.param(["spec", "--mtime=10"], (("spec",), {"mtime": 10}), id="--mtime"),
+    ],
+)
+def test_freeze(args, called_with):
+    cli_test(["freeze"] + args, "freeze", called_with)
+
+
+def test_dedupe(jupyter_dir, capsys):
+    for name in ("test-1", "in-both"):
+        (jupyter_dir / "kernels" / name / "logo.svg").write_text("<svg/>")
+    main(["dedupe", "--dry-run"])
+    assert "Would reclaim 6.0 B in 1 files" in capsys.readouterr().out
+    main(["dedupe", str(jupyter_dir / "kernels")])
+    assert "Reclaimed 6.0 B in 1 files" in capsys.readouterr().out
@@ -0,0 +1,75 @@
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from a2km import _completion
+from a2km._cli import _build_parser, main
+from tests.conftest import make_kernelspec
+
+
+def test_refresh_cache(jupyter_dir):
+    path = _completion.refresh_cache(only_if_exists=True)
+    assert not path.exists()
+    path = _completion.refresh_cache()
+    names = path.read_text().splitlines()
+    assert {"in-both", "test-1", "test-2"}.issubset(names)
+    assert names == sorted(names)
+
+
+def test_refresh_after_mutation(jupyter_dir, capsys):
+    path = _completion.refresh_cache()
+    main(["clone", "test-1", "test-3"])
+    assert "test-3" in path.read_text().splitlines()
+
+
+@pytest.mark.parametrize("shell", _completion.SHELLS)
+def test_script(shell, capsys):
+    main(["completion", shell])
+    script = capsys.readouterr().out
+    assert "add-env" in script
+    assert str(_completion.cache_path()) in script
+    if shell == "bash" or shutil.which(shell):
+        # syntax check
+        flags = ["--no-execute"] if shell == "fish" else ["-n"]
+        subprocess.run([shell, *flags], input=script, text=True, check=True)
+
+
+def _complete_bash(script, *words):
+    # run the completion function the way bash would
+    commands = f"""
+{script}
+COMP_WORDS=(a2km {" ".join(words)})
+COMP_CWORD={len(words)}
+_a2km
+printf '%s\\n' "${{COMPREPLY[@]}}"
+"""
+    out = subprocess.run(
+        ["bash", "-c", commands], capture_output=True, text=True, check=True
+    ).stdout
+    return out.split()
+
+
+def test_bash_completion(jupyter_dir):
+    script = _completion.script("bash", _build_parser()[0])
+    assert _complete_bash(script, "add-e") == ["add-env"]
+    assert "--where" in _complete_bash(script, "set", "--")
+    # no cache yet, refreshed in the background
+    assert _complete_bash(script, "show", "") == []
+    path = _completion.cache_path()
+    for _ in range(100):
+        if path.exists():
+            break
+        time.sleep(0.1)
+    assert _complete_bash(script, "show", "test-") == ["test-1", "test-2"]
+
+    # stale cache is refreshed by the next completion
+    time.sleep(0.01)
+    make_kernelspec("test-3", jupyter_dir / "kernels")
+    _complete_bash(script, "show", "")
+    for _ in range(100):
+        if "test-3" in path.read_text():
+            break
+        time.sleep(0.1)
+    assert _complete_bash(script, "show", "test-") == ["test-1", "test-2", "test-3"]
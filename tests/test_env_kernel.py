@@ -1,13 +1,21 @@
+import json
 import shutil
 import sys
 import tempfile
 from pathlib import Path
-from subprocess import check_call
+from subprocess import check_call, check_output, run
 
 import pytest
 from jupyter_client.manager import KernelManager
 
-from a2km.operations import env_kernel
+from a2km import operations
+from a2km.operations import (
+    _read_kernelspec,
+    env_kernel,
+    precompile,
+    prewarm,
+    profile,
+)
 
 
 @pytest.fixture(scope="session")
@@ -64,3 +72,113 @@ def test_conda_env_kernel(conda_env, jupyter_dir):
 def test_venv_kernel(venv, jupyter_dir):
     kernelspec = env_kernel(venv, kind="venv", install_data_dir=jupyter_dir)
     check_kernel_prefix(kernelspec.name, venv)
+
+
+def test_prewarm_venv_kernel(venv, jupyter_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv("A2KM_FORKSERVER_DIR", str(tmp_path / "forkserver"))
+    kernelspec = env_kernel(venv, kind="venv", install_data_dir=jupyter_dir)
+    prewarm(kernelspec, idle_timeout=5)
+    # start twice, the second launch is forked from the same forkserver
+    check_kernel_prefix(kernelspec.name, venv)
+    check_kernel_prefix(kernelspec.name, venv)
+    assert len(list((tmp_path / "forkserver").glob("*.log"))) == 1
+
+
+def test_precompile(tmp_path, monkeypatch):
+    # a small env of our own, so the session venv isn't compiled in place
+    env = tmp_path / "venv"
+    check_call([sys.executable, "-m", "venv", "--without-pip", str(env)])
+    site_packages = next(env.glob("lib/python*/site-packages"))
+    (site_packages / "mod.py").write_text("x = 1\n")
+    # only the env is writable, not the Python it's based on
+    monkeypatch.setattr(
+        operations, "_is_writable", lambda path: path.is_relative_to(env)
+    )
+    compileall = []
+    monkeypatch.setattr(
+        operations,
+        "run",
+        lambda cmd, **kwargs: compileall.append(cmd) or run(cmd, **kwargs),
+    )
+    pycache_prefix = tmp_path / "pycache"
+    assert precompile(env, kind="venv", pycache_prefix=pycache_prefix) is None
+    assert not pycache_prefix.exists()
+    assert list(site_packages.glob("__pycache__/mod.*.pyc"))
+    # the read-only standard library isn't compiled
+    compiled = [Path(arg) for arg in compileall[0][1:] if arg.startswith("/")]
+    assert site_packages in compiled
+    assert all(path.is_relative_to(env) for path in compiled)
+
+
+@pytest.fixture
+def compile_site_packages_only(monkeypatch):
+    """Skip compiling the standard library, which takes a long time"""
+
+    def run_site_packages(cmd, **kwargs):
+        if "compileall" in cmd:
+            cmd = cmd[:1] + [
+                arg
+                for arg in cmd[1:]
+                if not arg.startswith("/") or "site-packages" in arg
+            ]
+        return run(cmd, **kwargs)
+
+    monkeypatch.setattr(operations, "run", run_site_packages)
+
+
+def test_precompile_read_only_venv_kernel(
+    venv, jupyter_dir, monkeypatch, compile_site_packages_only
+):
+    monkeypatch.setattr(operations, "_is_writable", lambda path: False)
+    kernelspec = env_kernel(
+        venv, kind="venv", install_data_dir=jupyter_dir, compile_bytecode=True
+    )
+    spec = _read_kernelspec(kernelspec)
+    pycache_prefix = kernelspec / "pycache"
+    assert spec["env"]["PYTHONPYCACHEPREFIX"] == str(pycache_prefix)
+    site_packages = next(venv.glob("lib/python*/site-packages"))
+    assert list(pycache_prefix.glob(f"{site_packages}/ipykernel/*.pyc".lstrip("/")))
+    check_kernel_prefix(kernelspec.name, venv)
+
+
+def test_profile(venv, jupyter_dir, tmp_path, capsys):
+    kernelspec = env_kernel(venv, kind="venv", install_data_dir=jupyter_dir)
+    before = _read_kernelspec(kernelspec)
+    output = tmp_path / "profile.json"
+    report = profile(kernelspec, output=output, top=5)
+    assert _read_kernelspec(kernelspec) == before
+    assert json.loads(output.read_text()) == report
+    modules = {imp["module"] for imp in report["imports"]}
+    assert "ipykernel" in modules
+    assert report["memory"]["peak_rss"] > 0
+    captured = capsys.readouterr()
+    assert "Slowest imports" in captured.out
+
+
+def test_exec_venv_kernel(venv, jupyter_dir):
+    kernelspec = env_kernel(venv, kind="venv", install_data_dir=jupyter_dir)
+    out = check_output(
+        [
+            sys.executable,
+            "-m",
+            "a2km",
+            "exec",
+            kernelspec.name,
+            "--",
+            "python3",
+            "-c",
+            "import sys; print(sys.prefix)",
+        ],
+        text=True,
+    )
+    assert out.strip() == str(venv)
+
+
+def test_profile_prewarmed(venv, jupyter_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv("A2KM_FORKSERVER_DIR", str(tmp_path / "forkserver"))
+    kernelspec = env_kernel(venv, kind="venv", install_data_dir=jupyter_dir)
+    prewarm(kernelspec, idle_timeout=5)
+    report = profile(kernelspec, top=5)
+    # imports are profiled in the kernel, not a forkserver
+    assert "ipykernel" in {imp["module"] for imp in report["imports"]}
+    assert not (tmp_path / "forkserver").exists()
@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+from subprocess import run
+
+import pytest
+
+from a2km import _forkserver
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="Needs fork")
+
+fake_kernel_py = """
+import json, os, sys
+import preloaded
+with open(os.environ["FAKE_KERNEL_OUT"], "a") as f:
+    info = {
+        "argv": sys.argv[1:],
+        "pid": os.getpid(),
+        "ppid": os.getppid(),
+        "preload_pid": preloaded.pid,
+        "cwd": os.getcwd(),
+    }
+    f.write(json.dumps(info) + "\\n")
+print("hello from kernel")
+sys.exit(int(sys.argv[-1]))
+"""
+
+
+@pytest.fixture
+def fake_kernel(tmp_path):
+    (tmp_path / "fake_kernel.py").write_text(fake_kernel_py)
+    (tmp_path / "preloaded.py").write_text("import os\npid = os.getpid()\n")
+    (tmp_path / "cwd").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def kernel_out(tmp_path_factory):
+    # outside fake_kernel, which is on sys.path
+    return tmp_path_factory.mktemp("out") / "out.jsonl"
+
+
+def launch(fake_kernel: Path, kernel_out: Path, *args, wrapper=()):
+    env = os.environ.copy()
+    env.update(
+        {
+            "PYTHONPATH": str(fake_kernel),
+            "FAKE_KERNEL_OUT": str(kernel_out),
+            "A2KM_FORKSERVER_DIR": str(fake_kernel / "run"),
+        }
+    )
+    p = run(
+        [
+            *wrapper,
+            sys.executable,
+            _forkserver.__file__,
+            "--preload=preloaded",
+            "--module=fake_kernel",
+            "--idle-timeout=1",
+            "--",
+            *args,
+        ],
+        env=env,
+        cwd=fake_kernel / "cwd",
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    outputs = kernel_out.read_text().splitlines()
+    return p, json.loads(outputs[-1])
+
+
+def test_forkserver(fake_kernel, kernel_out):
+    p, info = launch(fake_kernel, kernel_out, "-f", "connection.json", "0")
+    assert p.returncode == 0, p.stderr
+    assert p.stdout == "hello from kernel\n"
+    assert info["argv"] == ["-f", "connection.json", "0"]
+    assert info["cwd"] == str(fake_kernel / "cwd")
+    # imported once in the forkserver
+    server_pid = info["ppid"]
+    assert info["preload_pid"] == server_pid
+
+    p, info = launch(fake_kernel, kernel_out, "3")
+    assert p.returncode == 3
+    assert p.stdout == "hello from kernel\n"
+    # same forkserver
+    assert info["ppid"] == server_pid
+
+    # idle forkserver exits
+    run_dir = fake_kernel / "run"
+    deadline = time.monotonic() + 30
+    while list(run_dir.glob("*.sock")):
+        assert time.monotonic() < deadline, "forkserver didn't exit"
+        time.sleep(0.1)
+
+
+def test_forkserver_env_change(fake_kernel, kernel_out):
+    p, info = launch(fake_kernel, kernel_out, "0")
+    server_pid = info["ppid"]
+    # adding a module changes the path stamp
+    (fake_kernel / "new_module.py").write_text("")
+    p, info = launch(fake_kernel, kernel_out, "0")
+    assert info["ppid"] != server_pid
+    assert info["preload_pid"] == info["ppid"]
+
+
+@pytest.mark.skipif(not shutil.which("prlimit"), reason="Needs prlimit")
+def test_forkserver_limits_change(fake_kernel, kernel_out):
+    p, info = launch(fake_kernel, kernel_out, "0")
+    server_pid = info["ppid"]
+    # kernels would inherit the forkserver's limits, not the client's
+    wrapper = ["prlimit", "--nofile=512"]
+    p, info = launch(fake_kernel, kernel_out, "0", wrapper=wrapper)
+    assert p.returncode == 0, p.stderr
+    limited_pid = info["ppid"]
+    assert limited_pid != server_pid
+    p, info = launch(fake_kernel, kernel_out, "0", wrapper=wrapper)
+    assert info["ppid"] == limited_pid
@@ -1,21 +1,43 @@
+import errno
 import json
+import os
+import shutil
+import socket
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen
 from unittest import mock
 
+import jupyter_core.paths
 import pytest
 
+from a2km import operations
 from a2km.operations import (
+    _load_catalog,
+    _parse_import_times,
     _read_kernelspec,
     add_argv,
     add_env,
+    build_catalog,
     clone,
+    dedupe,
+    find_kernelspecs,
+    freeze,
     locate,
+    map_kernelspecs,
+    prewarm,
+    purge,
     remove,
     remove_argv,
     remove_env,
     rename,
+    resources,
     set,
     show,
+    user_kernels_dirs,
 )
+from tests.conftest import make_kernelspec
 
 
 def test_locate(jupyter_dir, jupyter_dir_2):
@@ -108,6 +130,9 @@ def test_add_remove_argv(kernelspec, jupyter_dir):
     remove_argv(kernelspec, ["nosucharg"])
     after = _read_kernelspec(kernelspec)
     assert after["argv"] == argv
+    add_argv(kernelspec, ["nice", "-n", "5"], prepend=True)
+    after = _read_kernelspec(kernelspec)
+    assert after["argv"] == ["nice", "-n", "5"] + argv
 
 
 def test_clone(kernelspec, tmp_path):
@@ -127,6 +152,23 @@ def test_clone(kernelspec, tmp_path):
     assert before == after
 
 
+def test_clone_rename_relocate_env(kernelspec):
+    kernelspec_path = locate(kernelspec)
+    pycache = str(kernelspec_path / "pycache")
+    sibling = str(kernelspec_path) + "2"
+    add_env(kernelspec, {"PYTHONPYCACHEPREFIX": pycache, "OTHER": sibling})
+    cloned = clone(kernelspec, "clone")
+    env = _read_kernelspec(cloned)["env"]
+    assert env == {
+        "PYTHONPYCACHEPREFIX": str(cloned / "pycache"),
+        "OTHER": sibling,
+    }
+    renamed = rename("clone", "renamed")
+    env = _read_kernelspec(renamed)["env"]
+    assert env["PYTHONPYCACHEPREFIX"] == str(renamed / "pycache")
+    assert _read_kernelspec(kernelspec)["env"]["PYTHONPYCACHEPREFIX"] == pycache
+
+
 def test_remove(kernelspec):
     remove(kernelspec, force=True)
     with pytest.raises(FileNotFoundError):
@@ -144,3 +186,691 @@ def test_remove_prompt(kernelspec):
     assert mock_input.call_count == 1
     with pytest.raises(FileNotFoundError):
         locate(kernelspec)
+
+
+def test_catalog(jupyter_dir, capsys):
+    kernels_dir = jupyter_dir / "kernels"
+    catalog_path = build_catalog(kernels_dir)
+    assert catalog_path.parent == kernels_dir
+    catalog = _load_catalog(kernels_dir)
+    assert sorted(catalog) == ["in-both", "test-1"]
+    assert catalog["test-1"] == _read_kernelspec("test-1")
+
+    # external edits aren't noticed while the catalog is fresh
+    kernel_json = kernels_dir / "test-1" / "kernel.json"
+    spec = json.loads(kernel_json.read_text())
+    spec["display_name"] = "changed"
+    kernel_json.write_text(json.dumps(spec))
+    show("test-1")
+    captured = capsys.readouterr()
+    assert "Kernel: test-1 (Test-1 Kernel)" in captured.out
+    # names not in a fresh catalog are skipped
+    # (simulate a change not reflected in the directory mtime)
+    st = kernels_dir.stat()
+    make_kernelspec("sneaky", kernels_dir)
+    os.utime(kernels_dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert _load_catalog(kernels_dir) is not None
+    with pytest.raises(FileNotFoundError):
+        locate("sneaky")
+
+    # adding a kernelspec makes the catalog stale
+    make_kernelspec("new", kernels_dir)
+    assert _load_catalog(kernels_dir) is None
+    assert locate("sneaky") == kernels_dir / "sneaky"
+    show("test-1")
+    captured = capsys.readouterr()
+    assert "Kernel: test-1 (changed)" in captured.out
+
+
+def test_catalog_coarse_mtime(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    catalog_path = build_catalog(kernels_dir)
+    catalog = json.loads(catalog_path.read_text())
+    assert catalog["built_ns"] // 10**9 > catalog["mtime_ns"] // 10**9
+    # built in the same second as the directory's last change
+    catalog["built_ns"] = catalog["mtime_ns"]
+    catalog_path.write_text(json.dumps(catalog))
+    os.utime(kernels_dir, ns=(catalog["mtime_ns"], catalog["mtime_ns"]))
+    assert _load_catalog(kernels_dir) is None
+
+
+@pytest.mark.parametrize("catalog", [[], {"version": 1}, {"kernelspecs": []}])
+def test_catalog_invalid(jupyter_dir, catalog):
+    kernels_dir = jupyter_dir / "kernels"
+    (kernels_dir / ".a2km-catalog.json").write_text(json.dumps(catalog))
+    assert _load_catalog(kernels_dir) is None
+    assert locate("test-1") == kernels_dir / "test-1"
+
+
+def test_catalog_invalidated_by_write(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    build_catalog(kernels_dir)
+    assert _load_catalog(kernels_dir) is not None
+    set("test-1", {"key": "value"})
+    assert _load_catalog(kernels_dir) is None
+    assert _read_kernelspec("test-1")["key"] == "value"
+
+
+def test_prewarm(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    argv = ["python3", "-m", "ipykernel_launcher", "-f", "{connection_file}"]
+    make_kernelspec("ipy", kernels_dir, {"argv": argv})
+    prewarm("ipy", ["numpy"], idle_timeout=30)
+    spec = _read_kernelspec("ipy")
+    assert spec["argv"] == [
+        "python3",
+        "{resource_dir}/a2km_forkserver.py",
+        "--preload=ipykernel.kernelapp,numpy",
+        "--idle-timeout=30",
+        "--module=ipykernel_launcher",
+        "--",
+        "-f",
+        "{connection_file}",
+    ]
+    assert (kernels_dir / "ipy" / "a2km_forkserver.py").exists()
+    # update preload
+    prewarm("ipy", ["pandas"])
+    spec = _read_kernelspec("ipy")
+    assert spec["argv"][2] == "--preload=ipykernel.kernelapp,pandas"
+    assert spec["argv"].count("--") == 1
+
+    prewarm("ipy", disable=True)
+    spec = _read_kernelspec("ipy")
+    assert spec["argv"] == argv
+    assert not (kernels_dir / "ipy" / "a2km_forkserver.py").exists()
+
+
+def test_prewarm_unrecognized(kernelspec):
+    with pytest.raises(ValueError):
+        prewarm(kernelspec)
+    assert not (locate(kernelspec) / "a2km_forkserver.py").exists()
+
+
+def test_find_kernelspecs(jupyter_dir, jupyter_dir_2):
+    kernels_dir = jupyter_dir / "kernels"
+    kernels_dir_2 = jupyter_dir_2 / "kernels"
+    make_kernelspec(
+        "conda-a",
+        kernels_dir,
+        {"argv": ["conda", "run", "python3"], "env": {"SPARK_HOME": "/spark"}},
+    )
+    make_kernelspec("conda-b", kernels_dir_2, {"argv": ["conda", "run", "python3"]})
+    make_kernelspec("r", kernels_dir_2, {"language": "R"})
+    (kernels_dir / "not-a-kernel").mkdir()
+
+    assert find_kernelspecs(kernels_dirs=[kernels_dir, kernels_dir_2]) == [
+        kernels_dir / name for name in ("conda-a", "in-both", "test-1")
+    ] + [kernels_dir_2 / name for name in ("conda-b", "r", "test-2")]
+    assert find_kernelspecs("conda-*") == [
+        kernels_dir / "conda-a",
+        kernels_dir_2 / "conda-b",
+    ]
+    # only the highest priority
+    assert find_kernelspecs("in-*") == [kernels_dir / "in-both"]
+    assert find_kernelspecs(where=["language=R"]) == [kernels_dir_2 / "r"]
+    assert find_kernelspecs(where=["argv0=conda"]) == [
+        kernels_dir / "conda-a",
+        kernels_dir_2 / "conda-b",
+    ]
+    assert find_kernelspecs(where=["argv0=conda", "env=SPARK_HOME"]) == [
+        kernels_dir / "conda-a"
+    ]
+    assert find_kernelspecs("test-*", where=["argv0=conda"]) == []
+    with pytest.raises(ValueError):
+        find_kernelspecs(where=["language"])
+
+    # same result from a catalog
+    build_catalog(kernels_dir)
+    assert find_kernelspecs(where=["env=SPARK_HOME"]) == [kernels_dir / "conda-a"]
+
+
+def test_find_kernelspecs_no_symlinks(tmp_path):
+    kernels_dir = tmp_path / "kernels"
+    make_kernelspec("real", kernels_dir)
+    make_kernelspec("target", tmp_path / "elsewhere")
+    (kernels_dir / "linked-dir").symlink_to(tmp_path / "elsewhere" / "target")
+    (kernels_dir / "linked-json").mkdir()
+    (kernels_dir / "linked-json" / "kernel.json").symlink_to(
+        tmp_path / "elsewhere" / "target" / "kernel.json"
+    )
+    found = find_kernelspecs("*", kernels_dirs=[kernels_dir], unique=False)
+    assert sorted(p.name for p in found) == ["linked-dir", "linked-json", "real"]
+    found = find_kernelspecs(
+        "*", kernels_dirs=[kernels_dir], unique=False, follow_symlinks=False
+    )
+    assert found == [kernels_dir / "real"]
+
+
+def test_find_kernelspecs_shadowed(jupyter_dir, jupyter_dir_2):
+    make_kernelspec("k", jupyter_dir / "kernels", {"language": "R"})
+    make_kernelspec("k", jupyter_dir_2 / "kernels", {"language": "python"})
+    assert locate("k") == jupyter_dir / "kernels" / "k"
+    # the python kernelspec is shadowed by the R one, so it isn't selected
+    assert find_kernelspecs("k", where=["language=python"]) == []
+    assert find_kernelspecs("k", where=["language=R"]) == [
+        jupyter_dir / "kernels" / "k"
+    ]
+    assert find_kernelspecs("k", where=["language=python"], unique=False) == [
+        jupyter_dir_2 / "kernels" / "k"
+    ]
+
+
+def test_map_kernelspecs(jupyter_dir):
+    kernelspecs = find_kernelspecs("test-*")
+    kernelspecs.append(jupyter_dir / "kernels" / "nosuch")
+    results = map_kernelspecs(add_env, kernelspecs, {"key": "value"}, max_workers=2)
+    assert list(results) == kernelspecs
+    assert results[kernelspecs[0]] is None
+    assert results[kernelspecs[1]] is None
+    assert isinstance(results[kernelspecs[2]], FileNotFoundError)
+    for kernelspec in kernelspecs[:2]:
+        assert _read_kernelspec(kernelspec)["env"] == {"key": "value"}
+
+
+def test_update_conflict(kernelspec):
+    kernel_json = locate(kernelspec) / "kernel.json"
+    set(kernelspec, {"a": "before"})
+    real_read = operations._read_kernelspec_stamped
+    reads = 0
+
+    def read_then_concurrent_write(kernelspec):
+        nonlocal reads
+        reads += 1
+        result = real_read(kernelspec)
+        if reads == 1:
+            # another process updates the kernelspec after our read
+            spec = json.loads(kernel_json.read_text())
+            spec["b"] = "concurrent"
+            kernel_json.with_name("tmp").write_text(json.dumps(spec))
+            kernel_json.with_name("tmp").rename(kernel_json)
+        return result
+
+    with mock.patch.object(
+        operations, "_read_kernelspec_stamped", read_then_concurrent_write
+    ):
+        set(kernelspec, {"a": "after"})
+    assert reads == 2
+    spec = _read_kernelspec(kernelspec)
+    assert spec["a"] == "after"
+    assert spec["b"] == "concurrent"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="no flock")
+def test_update_without_flock(kernelspec):
+    # e.g. Lustre without -o flock
+    with mock.patch(
+        "fcntl.flock", side_effect=OSError(errno.ENOSYS, "Function not implemented")
+    ):
+        set(kernelspec, {"a": "b"})
+    assert _read_kernelspec(kernelspec)["a"] == "b"
+
+
+def test_concurrent_updates(kernelspec):
+    keys = [f"key{i}" for i in range(16)]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda key: add_env(kernelspec, {key: "x"}), keys))
+    assert sorted(_read_kernelspec(kernelspec)["env"]) == sorted(keys)
+
+
+def test_user_kernels_dirs(tmp_path):
+    users = tmp_path / "home"
+    make_kernelspec("k", users / "alice" / ".local" / "share" / "jupyter" / "kernels")
+    make_kernelspec("k", users / "bob" / "Library" / "Jupyter" / "kernels")
+    (users / "nokernels").mkdir()
+    assert user_kernels_dirs(users) == {
+        "alice": users / "alice" / ".local" / "share" / "jupyter" / "kernels",
+        "bob": users / "bob" / "Library" / "Jupyter" / "kernels",
+    }
+
+
+@pytest.mark.skipif(not hasattr(os, "fchown"), reason="no file ownership")
+def test_write_preserves_ownership(kernelspec, jupyter_dir):
+    kernel_json = jupyter_dir / "kernels" / kernelspec / "kernel.json"
+    kernel_json.chmod(0o640)
+    if os.getuid() == 0:
+        os.chown(kernel_json, 1234, 1234)
+    set(kernelspec, {"key": "value"})
+    st = kernel_json.stat()
+    assert st.st_mode & 0o777 == 0o640
+    if os.getuid() == 0:
+        assert (st.st_uid, st.st_gid) == (1234, 1234)
+
+
+def test_parse_import_times():
+    stderr = """\
+import time: self [us] | cumulative | imported package
+import time:       318 |        318 |   _io
+import time:       726 |       2016 | _frozen_importlib_external
+some other output
+import time:        12 |         30 |     a.b
+"""
+    assert _parse_import_times(stderr) == [
+        {"module": "_io", "self_us": 318, "cumulative_us": 318, "depth": 1},
+        {
+            "module": "_frozen_importlib_external",
+            "self_us": 726,
+            "cumulative_us": 2016,
+            "depth": 0,
+        },
+        {"module": "a.b", "self_us": 12, "cumulative_us": 30, "depth": 2},
+    ]
+
+
+def test_remove_to_trash(jupyter_dir, jupyter_dir_2):
+    kernels_dir = jupyter_dir / "kernels"
+    (kernels_dir / "test-1" / "resources").mkdir()
+    (kernels_dir / "test-1" / "resources" / "file").write_text("x")
+    remove("test-1", force=True, purge=False)
+    remove("in-both", force=True, purge=False)
+    remove("in-both", force=True, purge=False)
+    with pytest.raises(FileNotFoundError):
+        locate("test-1")
+    with pytest.raises(FileNotFoundError):
+        locate("in-both")
+    assert find_kernelspecs("*", kernels_dirs=[kernels_dir]) == []
+    trash_dir = kernels_dir / ".a2km-trash"
+    assert len(list(trash_dir.iterdir())) == 2
+    results = purge([kernels_dir, jupyter_dir_2 / "kernels"], max_workers=2)
+    assert len(results) == 3
+    assert all(error is None for error in results.values())
+    assert list(trash_dir.iterdir()) == []
+    assert purge([kernels_dir]) == {}
+
+
+def test_remove_trash_owner(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    kernels_dir.chmod(0o750)
+    trash_dir = kernels_dir / ".a2km-trash"
+    trash_dir.mkdir(mode=0o700)
+    remove("test-1", force=True, purge=False)
+    assert stat.S_IMODE(trash_dir.stat().st_mode) == 0o750
+    if os.geteuid() != 0:
+        return
+    # as root, the trash is owned by the owner of the kernels directory
+    os.chown(kernels_dir, 1234, 1234)
+    shutil.rmtree(trash_dir)
+    remove("in-both", force=True, purge=False)
+    assert (trash_dir.stat().st_uid, trash_dir.stat().st_gid) == (1234, 1234)
+
+
+def test_purge_trash_owner(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    remove("test-1", force=True, purge=False)
+    trash_dir = kernels_dir / ".a2km-trash"
+    if os.geteuid() == 0:
+        # not owned by the owner of the kernels directory
+        os.chown(trash_dir, 1234, 1234)
+        assert purge([kernels_dir]) == {}
+        os.chown(trash_dir, 0, 0)
+    assert len(purge([kernels_dir])) == 1
+
+
+def test_purge_failures(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    trash_dir = kernels_dir / ".a2km-trash"
+    trash_dir.mkdir()
+    (trash_dir / "link.abc").symlink_to(kernels_dir / "test-1")
+    # left behind by a purge that was killed
+    dead = Popen(["true"])
+    dead.wait()
+    interrupted = trash_dir / f"old.abc.purging-{socket.gethostname()}-{dead.pid}"
+    interrupted.mkdir()
+    # claimed by a purge that's still running
+    running = trash_dir / f"new.abc.purging-{socket.gethostname()}-{os.getpid()}"
+    running.mkdir()
+    failing = trash_dir / "failing.abc"
+    failing.mkdir()
+
+    real_rmtree = shutil.rmtree
+
+    def rmtree(path):
+        if path.name.startswith("failing"):
+            raise PermissionError(13, "Permission denied", str(path))
+        real_rmtree(path)
+
+    with mock.patch("shutil.rmtree", rmtree):
+        results = purge([kernels_dir])
+    assert isinstance(results[failing], PermissionError)
+    assert results[interrupted] is None
+    assert running not in results
+    # symlinks are removed, not followed
+    assert (kernels_dir / "test-1" / "kernel.json").exists()
+    assert sorted(p.name for p in trash_dir.iterdir()) == [failing.name, running.name]
+    # the failed entry is retried by the next purge
+    assert purge([kernels_dir]) == {failing: None}
+
+
+def test_remove_purge_in_background(kernelspec):
+    kernels_dir = locate(kernelspec).parent
+    with mock.patch.object(operations, "Popen") as mock_popen:
+        remove(kernelspec, force=True, purge=True)
+    mock_popen.assert_called_once()
+    cmd = mock_popen.call_args.args[0]
+    assert cmd[-2:] == ["purge", str(kernels_dir)]
+
+
+def _tree_state(root):
+    state = {}
+    for path in sorted(root.rglob("*")) + [root]:
+        st = path.stat()
+        content = path.read_bytes() if path.is_file() else None
+        state[str(path.relative_to(root))] = (st.st_mode, st.st_mtime_ns, content)
+    return state
+
+
+def test_freeze(jupyter_dir, tmp_path, monkeypatch):
+    kernels_dir = jupyter_dir / "kernels"
+    for name in ("a", "b"):
+        kernel_dir = kernels_dir / name
+        make_kernelspec(
+            name,
+            kernels_dir,
+            {
+                "display_name": "Same",
+                "argv": ["python3", str(kernel_dir / "launch.py")],
+                "env": {"b": "1", "a": "2"},
+            },
+        )
+        (kernel_dir / "logo-32x32.png").write_bytes(b"png")
+        (kernel_dir / "logo-32x32.png").chmod(0o600)
+        (kernel_dir / "launch.py").write_text("")
+        (kernel_dir / "launch.py").chmod(0o700)
+        (kernel_dir / "kernel.json.a2km.abc").write_text("leftover")
+
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    freeze("a")
+    freeze(kernels_dir / "b")
+    state = _tree_state(kernels_dir / "a")
+    assert state == _tree_state(kernels_dir / "b")
+    assert "kernel.json.a2km.abc" not in state
+    assert state["logo-32x32.png"][0] & 0o777 == 0o644
+    assert state["launch.py"][0] & 0o777 == 0o755
+    assert {mtime for mode, mtime, content in state.values()} == {
+        1_700_000_000 * 1_000_000_000
+    }
+    spec = _read_kernelspec("a")
+    assert spec["argv"] == ["python3", "{resource_dir}/launch.py"]
+    assert list(spec) == sorted(spec)
+    assert list(spec["env"]) == ["a", "b"]
+
+    freeze("a", mtime=0)
+    assert (kernels_dir / "a").stat().st_mtime_ns == 0
+
+
+def test_freeze_resource_dir(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    kernel_dir = kernels_dir / "py"
+    sibling = str(kernels_dir / "py3" / "launch.py")
+    make_kernelspec(
+        "py", kernels_dir, {"argv": ["python3", str(kernel_dir / "x.py"), sibling]}
+    )
+    freeze("py")
+    assert _read_kernelspec("py")["argv"] == [
+        "python3",
+        "{resource_dir}/x.py",
+        sibling,
+    ]
+    no_argv = kernels_dir / "no-argv"
+    no_argv.mkdir()
+    (no_argv / "kernel.json").write_text(json.dumps({"display_name": "x"}))
+    freeze("no-argv")
+    assert _read_kernelspec("no-argv") == {"display_name": "x"}
+
+
+def test_dedupe(jupyter_dir, jupyter_dir_2):
+    logos = []
+    for kernels_dir, name in [
+        (jupyter_dir / "kernels", "test-1"),
+        (jupyter_dir / "kernels", "in-both"),
+        (jupyter_dir_2 / "kernels", "test-2"),
+    ]:
+        logo = kernels_dir / name / "logo-64x64.png"
+        logo.write_bytes(b"logo" * 100)
+        logos.append(logo)
+    different = jupyter_dir_2 / "kernels" / "in-both" / "logo-64x64.png"
+    different.write_bytes(b"LOGO" * 100)
+    private = jupyter_dir_2 / "kernels" / "in-both" / "private.png"
+    private.write_bytes(b"logo" * 100)
+    private.chmod(0o600)
+    kernel_json = jupyter_dir / "kernels" / "test-1" / "kernel.json"
+    (jupyter_dir / "kernels" / "in-both" / "kernel.json").write_bytes(
+        kernel_json.read_bytes()
+    )
+
+    assert dedupe(dry_run=True) == (800, 2, 0)
+    assert len({logo.stat().st_ino for logo in logos}) == 3
+
+    assert dedupe() == (800, 2, 0)
+    assert len({logo.stat().st_ino for logo in logos}) == 1
+    assert logos[0].stat().st_nlink == 3
+    assert logos[0].read_bytes() == b"logo" * 100
+    # different contents, permissions, or kernel.json aren't linked
+    assert different.stat().st_nlink == 1
+    assert private.stat().st_nlink == 1
+    assert kernel_json.stat().st_nlink == 1
+    # no temporary files left behind
+    assert sorted(p.name for p in logos[0].parent.iterdir()) == [
+        "kernel.json",
+        "logo-64x64.png",
+    ]
+
+    assert dedupe() == (0, 0, 0)
+
+
+def test_dedupe_failures(jupyter_dir):
+    kernels_dir = jupyter_dir / "kernels"
+    make_kernelspec("test-2", kernels_dir)
+    logos = []
+    for name in ("test-1", "in-both", "test-2"):
+        logo = kernels_dir / name / "logo-64x64.png"
+        logo.write_bytes(b"logo" * 100)
+        logos.append(logo)
+    read_only = kernels_dir / "in-both"
+
+    def access(path, mode):
+        return os.fspath(path) != str(read_only)
+
+    with mock.patch("os.access", access):
+        assert dedupe(dry_run=True) == (400, 1, 1)
+
+    real_link = os.link
+
+    def link(src, dst):
+        if os.path.dirname(dst) == str(read_only):
+            raise OSError(errno.EMLINK, "Too many links", str(dst))
+        real_link(src, dst)
+
+    with mock.patch("os.link", link):
+        # the other files are still linked
+        assert dedupe() == (400, 1, 1)
+    assert logos[1].stat().st_nlink == 1
+    assert logos[0].stat().st_ino == logos[2].stat().st_ino
+    assert sorted(p.name for p in read_only.iterdir()) == [
+        "kernel.json",
+        "logo-64x64.png",
+    ]
+
+
+def test_dedupe_then_change(jupyter_dir, monkeypatch):
+    kernels_dir = jupyter_dir / "kernels"
+    argv = ["python3", "-m", "ipykernel_launcher", "-f", "{connection_file}"]
+    for name in ("a", "b"):
+        make_kernelspec(name, kernels_dir, {"argv": argv})
+        (kernels_dir / name / "logo-64x64.png").write_bytes(b"logo" * 100)
+    prewarm("a")
+    prewarm("b")
+    dedupe()
+    script = kernels_dir / "b" / "a2km_forkserver.py"
+    logo = kernels_dir / "b" / "logo-64x64.png"
+    assert script.stat().st_nlink == logo.stat().st_nlink == 2
+    before = _tree_state(kernels_dir / "b")
+
+    # neither replaces nor modifies files shared with b
+    prewarm("a", ["numpy"])
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    freeze("a")
+    assert _tree_state(kernels_dir / "b") == before
+    assert script.stat().st_nlink == logo.stat().st_nlink == 1
+    assert (kernels_dir / "a" / "logo-64x64.png").read_bytes() == b"logo" * 100
+
+
+def test_resolve_env(jupyter_dir, tmp_path):
+    env = tmp_path / "venv"
+    (env / "bin").mkdir(parents=True)
+    (env / "bin" / "activate").write_text(
+        "export FROM_ACTIVATE=yes\nexport PATH=/activated:$PATH\nunset TO_UNSET\n"
+    )
+    make_kernelspec(
+        "test-venv",
+        jupyter_dir / "kernels",
+        {
+            "argv": operations._env_commands(env, "venv")[1] + ["python3"],
+            "env": {"ENV_PREFIX": str(env), "FROM_SPEC": "spec"},
+        },
+    )
+    with mock.patch.dict(os.environ, {"TO_UNSET": "x"}):
+        environ = operations.resolve_env("test-venv")
+        assert environ["FROM_ACTIVATE"] == "yes"
+        assert environ["FROM_SPEC"] == "spec"
+        assert environ["PATH"] == "/activated:" + os.environ["PATH"]
+        assert "TO_UNSET" not in environ
+
+        # cached, doesn't run the preamble again
+        with mock.patch.object(operations, "check_output") as check_output:
+            assert operations.resolve_env("test-venv") == environ
+        check_output.assert_not_called()
+
+        # modifying the env invalidates the cache
+        (env / "bin" / "activate").write_text("export FROM_ACTIVATE=changed\n")
+        assert operations.resolve_env("test-venv")["FROM_ACTIVATE"] == "changed"
+
+        # taskset/prlimit from `resources` don't hide the preamble
+        resources("test-venv", cpus="0")
+        assert operations.resolve_env("test-venv")["FROM_ACTIVATE"] == "changed"
+
+    # no preamble, only the spec env is applied
+    environ = operations.resolve_env("test-1")
+    assert environ == os.environ
+
+
+def test_spec_cache(kernelspec, jupyter_dir):
+    operations.cache_clear()
+    spec = _read_kernelspec(kernelspec)
+    assert operations.cache_info()[:2] == (0, 1)
+    # modifying the result doesn't modify the cache
+    spec["argv"].append("--modified")
+    assert "--modified" not in _read_kernelspec(kernelspec)["argv"]
+    assert operations.cache_info()[:2] == (1, 1)
+
+    # invalidated by a2km writes
+    add_env(kernelspec, {"key": "value"})
+    assert _read_kernelspec(kernelspec)["env"] == {"key": "value"}
+
+    # and by other writers
+    kernel_json = jupyter_dir / "kernels" / kernelspec / "kernel.json"
+    new_file = kernel_json.with_name("new.json")
+    new_file.write_text(json.dumps({"argv": ["other"]}))
+    new_file.replace(kernel_json)
+    assert _read_kernelspec(kernelspec) == {"argv": ["other"]}
+
+    operations.cache_resize(1)
+    _read_kernelspec("test-2")
+    assert operations.cache_info().currsize == 1
+    operations.cache_resize(0)
+    _read_kernelspec("test-2")
+    assert operations.cache_info().currsize == 0
+    operations.cache_resize(1024)
+
+
+def test_spec_cache_threads(jupyter_dir):
+    operations.cache_clear()
+    names = ["test-1", "test-2", "in-both"] * 100
+    with ThreadPoolExecutor(8) as pool:
+        specs = list(pool.map(_read_kernelspec, names))
+    assert specs[:3] == specs[-3:]
+    info = operations.cache_info()
+    assert info.hits + info.misses == len(names)
+    assert info.currsize == 3
+
+
+def test_spec_cache_threads_on_path(tmp_path, monkeypatch):
+    # a prefix on $PATH, found by name
+    prefix = tmp_path / "prefix"
+    (prefix / "bin").mkdir(parents=True)
+    make_kernelspec("on-path", prefix / "share" / "jupyter" / "kernels")
+    monkeypatch.setenv("PATH", f"{prefix / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    system_jupyter_path = list(jupyter_core.paths.SYSTEM_JUPYTER_PATH)
+    real_jupyter_path = jupyter_core.paths.jupyter_path
+
+    def jupyter_path(*subdirs):
+        # other threads would see a patched global
+        assert jupyter_core.paths.SYSTEM_JUPYTER_PATH == system_jupyter_path
+        return real_jupyter_path(*subdirs)
+
+    operations.cache_clear()
+    names = ["on-path", "test-1"] * 100
+    with (
+        mock.patch("jupyter_core.paths.jupyter_path", jupyter_path),
+        ThreadPoolExecutor(8) as pool,
+    ):
+        specs = list(pool.map(_read_kernelspec, names))
+    assert specs[:2] == specs[-2:]
+    # jupyter_core isn't changed
+    assert jupyter_core.paths.SYSTEM_JUPYTER_PATH == system_jupyter_path
+    assert str(prefix / "share" / "jupyter") not in jupyter_core.paths.jupyter_path()
+    assert prefix / "share" / "jupyter" / "kernels" in operations._kernels_dirs()
+
+
+def test_resources(kernelspec, capsys):
+    before = _read_kernelspec(kernelspec)
+    add_env(kernelspec, {"OTHER": "x"})
+    resources(kernelspec, cpus="0-3,8", memory="1G")
+    spec = _read_kernelspec(kernelspec)
+    assert (
+        spec["argv"]
+        == [
+            "taskset",
+            "-c",
+            "0-3,8",
+            "prlimit",
+            f"--as={1 << 30}",
+        ]
+        + before["argv"]
+    )
+    assert spec["env"] == {
+        "OTHER": "x",
+        "OMP_NUM_THREADS": "5",
+        "MKL_NUM_THREADS": "5",
+        "OPENBLAS_NUM_THREADS": "5",
+    }
+    show(kernelspec)
+    captured = capsys.readouterr()
+    assert "resources: threads=5 cpus=0-3,8 memory=1G" in captured.out
+    assert "OMP_NUM_THREADS=5" in captured.out
+
+    # replaces previous settings
+    resources(kernelspec, threads=2)
+    spec = _read_kernelspec(kernelspec)
+    assert spec["argv"] == before["argv"]
+    assert spec["env"]["MKL_NUM_THREADS"] == "2"
+
+    # variables changed by other means are left alone
+    add_env(kernelspec, {"OMP_NUM_THREADS": "3"})
+    resources(kernelspec, clear=True)
+    spec = _read_kernelspec(kernelspec)
+    assert spec["env"] == {"OTHER": "x", "OMP_NUM_THREADS": "3"}
+    assert "metadata" not in spec
+
+    # variables set before are restored
+    resources(kernelspec, threads=4)
+    assert _read_kernelspec(kernelspec)["env"]["OMP_NUM_THREADS"] == "4"
+    resources(kernelspec, threads=6)
+    resources(kernelspec, clear=True)
+    spec = _read_kernelspec(kernelspec)
+    assert spec["env"] == {"OTHER": "x", "OMP_NUM_THREADS": "3"}
+    assert "metadata" not in spec
+
+    with pytest.raises(ValueError):
+        resources(kernelspec, cpus="all")
+    with pytest.raises(ValueError):
+        resources(kernelspec, memory="lots")
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from a2km import _serialize
+from a2km.operations import _read_kernelspec, locate, set
+
+_spec = {
+    "argv": ["python3", "-m", "ipykernel_launcher", "-f", "{connection_file}"],
+    "display_name": "Pythön 3",
+    "language": "python",
+    "env": {"b": "1", "a": "2"},
+}
+
+
+@pytest.fixture(params=["json", "orjson"])
+def backend(request):
+    if request.param == "orjson":
+        orjson = pytest.importorskip("orjson")
+    else:
+        orjson = None
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(_serialize, "orjson", orjson)
+        yield request.param
+
+
+def test_backend(backend):
+    assert _serialize.backend() == backend
+
+
+def test_loads(backend):
+    text = json.dumps(_spec)
+    assert _serialize.loads(text) == _spec
+    assert _serialize.loads(text.encode("utf8")) == _spec
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "123456789012345678901234567890",
+        "-9223372036854775809",
+        '{"n": 18446744073709551615, "x": [NaN, Infinity, -Infinity]}',
+    ],
+)
+def test_loads_like_json(backend, text):
+    # the same values as the stdlib json module, whichever backend is used
+    expected = json.loads(text)
+    assert repr(_serialize.loads(text)) == repr(expected)
+    assert repr(_serialize.loads(text.encode("utf8"))) == repr(expected)
+    assert _serialize.dumps(_serialize.loads(text)) == json.dumps(expected, indent=1)
+
+
+def test_loads_invalid(backend):
+    with pytest.raises(ValueError):
+        _serialize.loads("{not json")
+
+
+def test_dumps(backend):
+    # output doesn't depend on the backend
+    assert _serialize.dumps(_spec) == json.dumps(_spec, indent=1)
+    assert list(_serialize.loads(_serialize.dumps(_spec))["env"]) == ["b", "a"]
+
+
+def test_set_no_change(kernelspec):
+    set(kernelspec, {"key": "value"})
+    kernel_json = locate(kernelspec) / "kernel.json"
+    before_stat = kernel_json.stat()
+    set(kernelspec, {"key": "value"})
+    assert kernel_json.stat().st_ino == before_stat.st_ino
+    assert _read_kernelspec(kernelspec)["key"] == "value"